@@ -1,22 +1,47 @@
 # acoustid-api/main.py
 import os
-import subprocess
+import re
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, Form, File
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-import requests
 import shutil
 from pathlib import Path
 
 import logging
 
+try:
+    import chromaprint  # pyacoustid's ctypes binding to libchromaprint
+except ImportError:  # no binding: fingerprint by piping PCM into `fpcalc -` instead
+    chromaprint = None
+
+from acoustid_client import ACOUSTID_CACHE_PATH, AcoustIDClient, LookupCache
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(levelname)-9s %(message)s",
 )
 logger = logging.getLogger("acousti")
 
-app = FastAPI()
+# cached, rate-limited and batched; see acoustid_client.py
+ACOUSTID = AcoustIDClient(os.getenv("ACOUSTID_API_KEY"), LookupCache(ACOUSTID_CACHE_PATH))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if not ACOUSTID.api_key:
+        logger.error("ACOUSTID_API_KEY is not set; only cached lookups will match")
+    purged = await ACOUSTID.cache.purge()
+    if purged:
+        logger.info("🟦Dropped %d expired AcoustID lookups", purged)
+    try:
+        yield
+    finally:
+        await ACOUSTID.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Optional: Allow frontend calls during local dev
 app.add_middleware(
@@ -27,16 +52,87 @@ app.add_middleware(
 )
 
 
-def run_fpcalc(file_path):
-    result = subprocess.run(["fpcalc", file_path], capture_output=True, text=True)
+# ffmpeg / fpcalc run as asyncio subprocesses so the event loop (and /health) never
+# blocks on them. At most SUBPROCESS_CONCURRENCY run at once -- they are CPU bound,
+# so default to one per core -- and the rest wait their turn.
+SUBPROCESS_CONCURRENCY = int(os.getenv("SUBPROCESS_CONCURRENCY", str(os.cpu_count() or 2)))
+FFMPEG_TIMEOUT_SECS = float(os.getenv("FFMPEG_TIMEOUT_SECS", "300"))
+FPCALC_TIMEOUT_SECS = float(os.getenv("FPCALC_TIMEOUT_SECS", "120"))
+
+_proc_slots = asyncio.Semaphore(SUBPROCESS_CONCURRENCY)
+_proc_stats = {"running": 0, "queued": 0, "timeouts": 0}
+
+
+@asynccontextmanager
+async def process_slot():
+    """Hold one of the SUBPROCESS_CONCURRENCY slots, queueing until one is free."""
+    _proc_stats["queued"] += 1
+    try:
+        await _proc_slots.acquire()
+    finally:
+        _proc_stats["queued"] -= 1
+    _proc_stats["running"] += 1
+    try:
+        yield
+    finally:
+        _proc_stats["running"] -= 1
+        _proc_slots.release()
+
+
+async def kill_process(proc):
+    """
+    Kill and reap. Whatever is still sitting in its pipes gets drained, since
+    asyncio won't report the exit until they close.
+    """
+    if proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+    async def reap():
+        for stream in (proc.stdout, proc.stderr):
+            if stream is not None:
+                await stream.read()
+        await proc.wait()
+
+    await asyncio.shield(reap())
 
-    if "FINGERPRINT=" not in result.stdout or "DURATION=" not in result.stdout:
-        raise RuntimeError(f"fpcalc failed: {result.stderr}")
+
+async def run_process(args, timeout):
+    """
+    Run a command and return (returncode, stdout, stderr) as text.
+    Raises RuntimeError on timeout; the process is killed on timeout or if the
+    caller is cancelled, so an abandoned request doesn't leave ffmpeg running.
+    """
+    async with process_slot():
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(), timeout)
+        except BaseException as e:
+            await kill_process(proc)
+            if isinstance(e, asyncio.TimeoutError):
+                _proc_stats["timeouts"] += 1
+                raise RuntimeError(f"{args[0]} timed out after {timeout:g}s")
+            raise
+        return proc.returncode, out.decode(errors="replace"), err.decode(errors="replace")
+
+
+async def run_fpcalc(file_path):
+    returncode, stdout, stderr = await run_process(["fpcalc", file_path], FPCALC_TIMEOUT_SECS)
+
+    if "FINGERPRINT=" not in stdout or "DURATION=" not in stdout:
+        raise RuntimeError(f"fpcalc failed: {stderr}")
 
     fingerprint = None
     duration = None
 
-    for line in result.stdout.splitlines():
+    for line in stdout.splitlines():
         if line.startswith("FINGERPRINT="):
             fingerprint = line.split("=", 1)[1]
         elif line.startswith("DURATION="):
@@ -48,21 +144,237 @@ def run_fpcalc(file_path):
     return fingerprint, duration
 
 
-def lookup_acoustid(fingerprint, duration, api_key):
-    url = "https://api.acoustid.org/v2/lookup"
-    payload = {
-        "client": api_key,
-        "format": "json",
-        "fingerprint": fingerprint,
-        "duration": duration,
-        "meta": "recordings"
-    }
+async def lookup_acoustid(fingerprint, duration):
+    return await ACOUSTID.lookup(fingerprint, int(duration))
+
+
+def parse_matches(raw_result):
+    matches = []
+    for result in raw_result.get("results", []):
+        for recording in result.get("recordings", []):
+            title = recording.get("title", "Unknown")
+            artist = "Unknown"
+            if recording.get("artists"):
+                artist = recording["artists"][0].get("name", "Unknown")
+            matches.append({"title": title, "artist": artist})
+    return matches
+
+
+# what /analyze can write for the next stage, as "codec:rate:channels" (see parse_format)
+OUTPUT_CODECS = {
+    "flac": ("flac", ["-c:a", "flac", "-sample_fmt", "s16"]),
+    "wav": ("wav", ["-c:a", "pcm_s16le"]),
+}
+
+# /analyze decodes once to the PCM everything downstream used to re-read from the WAV.
+# This stays 44.1 kHz stereo whatever the stage formats: it's what fpcalc always saw,
+# so fingerprints (and their hashes) match the ones already stored.
+PCM_RATE = 44100
+PCM_CHANNELS = 2
+FRAME_BYTES = 2 * PCM_CHANNELS  # s16le
+PCM_ARGS = ["-acodec", "pcm_s16le", "-ar", str(PCM_RATE), "-ac", str(PCM_CHANNELS)]
+# fpcalc's default -length; the fingerprint only ever covers the start of the track
+FINGERPRINT_SECS = int(os.getenv("FINGERPRINT_SECS", "120"))
+PIPE_READ_BYTES = 1 << 20
+DURATION_RE = re.compile(rb"Duration: (N/A|(\d+):(\d\d):(\d\d(?:\.\d+)?))")
+
+
+class UnusableAudio(RuntimeError):
+    """ffmpeg couldn't decode it, or there was nothing to fingerprint. Retrying won't help."""
+
 
-    response = requests.post(url, data=payload)
-    if response.status_code != 200:
-        raise RuntimeError(f"AcoustID error: {response.text}")
+def parse_format(spec: str):
+    """'flac:16000:1' -> (extension, ffmpeg output args)."""
+    try:
+        codec, rate, channels = spec.split(":")
+        ext, codec_args = OUTPUT_CODECS[codec]
+        rate, channels = int(rate), int(channels)
+    except (KeyError, ValueError):
+        raise ValueError(f"bad output_format {spec!r}, expected codec:rate:channels "
+                         f"with codec one of {', '.join(OUTPUT_CODECS)}")
+    return ext, [*codec_args, "-ar", str(rate), "-ac", str(channels)]
+
+
+class StreamFingerprinter:
+    """
+    Chromaprint over s16le PCM as it arrives. Runs in-process through libchromaprint
+    when the binding imports, otherwise pipes the same PCM into `fpcalc -`; same
+    library, same fingerprint. Like fpcalc, only the first FINGERPRINT_SECS count.
+    """
+
+    def __init__(self):
+        self.remaining = FINGERPRINT_SECS * PCM_RATE * FRAME_BYTES
+        self._carry = b""
+        self._fp = None
+        self._proc = None
+
+    @property
+    def full(self):
+        return self.remaining <= 0
+
+    async def start(self):
+        if chromaprint is not None:
+            self._fp = chromaprint.Fingerprinter()
+            self._fp.start(PCM_RATE, PCM_CHANNELS)
+        else:
+            self._proc = await asyncio.create_subprocess_exec(
+                "fpcalc", "-format", "s16le", "-rate", str(PCM_RATE),
+                "-channels", str(PCM_CHANNELS), "-length", str(FINGERPRINT_SECS), "-",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+
+    async def feed(self, pcm: bytes):
+        # keep whole frames together; pipe reads split wherever they like
+        pcm = self._carry + pcm[:self.remaining]
+        cut = len(pcm) - len(pcm) % FRAME_BYTES
+        pcm, self._carry = pcm[:cut], pcm[cut:]
+        self.remaining -= len(pcm)
+        if not pcm:
+            return
+        if self._fp is not None:
+            await asyncio.to_thread(self._fp.feed, pcm)
+        else:
+            self._proc.stdin.write(pcm)
+            await self._proc.stdin.drain()
+
+    async def finish(self) -> str:
+        if self._fp is not None:
+            fingerprint = await asyncio.to_thread(self._fp.finish)
+            fingerprint = fingerprint.decode() if isinstance(fingerprint, bytes) else fingerprint
+            if not fingerprint:
+                raise UnusableAudio("chromaprint produced no fingerprint")
+            return fingerprint
+        self._proc.stdin.close()
+        out, err = await self._proc.communicate()
+        for line in out.decode(errors="replace").splitlines():
+            if line.startswith("FINGERPRINT="):
+                return line.split("=", 1)[1]
+        raise UnusableAudio(f"fpcalc failed: {err.decode(errors='replace')}")
+
+    async def close(self):
+        if self._proc is not None:
+            await kill_process(self._proc)
+
+
+async def analyze_audio(file_path: str, output_format: str = "") -> dict:
+    """
+    Decode the upload once. ffmpeg writes it in output_format (only when a later
+    stage wants the audio) and streams PCM to us on stdout, which is fingerprinted
+    as it arrives. The AcoustID lookup starts as soon as the fingerprint is done,
+    while ffmpeg is still writing the rest of the file. The upload is removed once it's
+    analyzed, or once it's known to be undecodable; any other failure leaves it for a retry.
+    """
+    args = ["ffmpeg", "-nostdin", "-hide_banner", "-nostats", "-y", "-i", file_path]
+    output_path = None
+    if output_format:
+        ext, output_args = parse_format(output_format)
+        output_path = f"/shared_data/preprocessed/{os.path.basename(file_path)}.{ext}"
+        args += [*output_args, output_path]
+    args += [*PCM_ARGS, "-f", "s16le", "pipe:1"]
+
+    loop = asyncio.get_running_loop()
+    header_duration = loop.create_future()
+    lookup = None
+
+    async def read_stderr(proc):
+        log = bytearray()
+        while line := await proc.stderr.readline():
+            log += line
+            m = not header_duration.done() and DURATION_RE.search(line)
+            if m:
+                header_duration.set_result(
+                    None if m.group(1) == b"N/A"
+                    else int(m.group(2)) * 3600 + int(m.group(3)) * 60 + float(m.group(4))
+                )
+        if not header_duration.done():
+            header_duration.set_result(None)
+        return log[-4000:].decode(errors="replace")
+
+    def start_lookup(fingerprint, duration):
+        return asyncio.create_task(lookup_acoustid(fingerprint, duration))
 
-    return response.json()
+    async def pump(proc, fper):
+        # -> (fingerprint, pcm bytes read, whether ffmpeg was left to finish)
+        nonlocal lookup
+        fingerprint, total = None, 0
+        while chunk := await proc.stdout.read(PIPE_READ_BYTES):
+            total += len(chunk)
+            if fingerprint is not None:
+                continue  # just draining so ffmpeg keeps writing the output file
+            await fper.feed(chunk)
+            if fper.full:
+                fingerprint = await fper.finish()
+                # ffmpeg prints the container duration before any audio, so it's usually
+                # known by now; if not, the lookup waits for the decoded length instead
+                duration = header_duration.result() if header_duration.done() else None
+                if duration:
+                    lookup = start_lookup(fingerprint, duration)
+                    if output_path is None:
+                        return fingerprint, total, False
+        if fingerprint is None:
+            fingerprint = await fper.finish()  # shorter than FINGERPRINT_SECS
+        return fingerprint, total, True
+
+    try:
+        async with process_slot():
+            proc = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            stderr_task = asyncio.create_task(read_stderr(proc))
+            fper = StreamFingerprinter()
+            try:
+                await fper.start()
+                try:
+                    fingerprint, total, finished = await asyncio.wait_for(
+                        pump(proc, fper), FFMPEG_TIMEOUT_SECS
+                    )
+                except asyncio.TimeoutError:
+                    _proc_stats["timeouts"] += 1
+                    raise RuntimeError(f"ffmpeg timed out after {FFMPEG_TIMEOUT_SECS:g}s")
+                if not finished:
+                    proc.kill()  # fingerprint and duration are all we needed
+                stderr = await stderr_task
+                await kill_process(proc)
+                if finished and proc.returncode != 0:
+                    raise UnusableAudio(f"FFmpeg failed (stderr={stderr})")
+            finally:
+                stderr_task.cancel()
+                await fper.close()
+                await kill_process(proc)
+
+        duration = total / (PCM_RATE * FRAME_BYTES) if finished else header_duration.result()
+        if not duration:
+            raise UnusableAudio("no audio decoded")
+        if lookup is None:
+            lookup = start_lookup(fingerprint, duration)
+        try:
+            matches = parse_matches(await lookup)
+        except Exception as e:
+            # the fingerprint is still good for dedupe; just no names for it
+            logger.warning("AcoustID lookup failed: %s", e)
+            matches = []
+    except BaseException as e:
+        if lookup is not None:
+            lookup.cancel()
+        if output_path and os.path.exists(output_path):
+            os.remove(output_path)
+        if isinstance(e, UnusableAudio):
+            # no retry will decode it either
+            os.remove(file_path) if os.path.exists(file_path) else None
+        raise
+
+    os.remove(file_path) if os.path.exists(file_path) else None
+    return {
+        "file_path": output_path,
+        "fingerprint": fingerprint,
+        "duration": int(duration),
+        "matches": matches,
+    }
 
 async def convert_audio(file_path: str) -> str:
     """
@@ -79,27 +391,34 @@ async def convert_audio(file_path: str) -> str:
     #     shutil.copyfileobj(file.file, f)
 
     try:
-        subprocess.run(
+        returncode, stdout, stderr = await run_process(
             [
                 "ffmpeg", "-y", "-i", input_path,
                 "-acodec", "pcm_s16le", "-ar", "44100", "-ac", "2",
                 output_path
             ],
-            check=True,
-            capture_output=True,
-            text=True
+            FFMPEG_TIMEOUT_SECS,
         )
-        os.remove(input_path)
-        return output_path  
-    except subprocess.CalledProcessError as e:
+    except RuntimeError:
+        # timed out: don't leave the input or a half-written WAV behind
+        for p in (input_path, output_path):
+            os.remove(p) if os.path.exists(p) else None
+        raise
+    if returncode != 0:
         os.remove(input_path) if os.path.exists(input_path) else None
         raise RuntimeError(
-            f"FFmpeg failed (stdout={e.stdout}, stderr={e.stderr})"
+            f"FFmpeg failed (stdout={stdout}, stderr={stderr})"
         )
+    os.remove(input_path)
+    return output_path
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "subprocesses": {**_proc_stats, "max": SUBPROCESS_CONCURRENCY},
+        "acoustid": ACOUSTID.stats(),
+    }
 
 
 @app.post("/convert")
@@ -121,21 +440,9 @@ async def identify(file_path: str = Form(...)):
     try:
         logger.info("🟦Identifying")
         
-        api_key = os.getenv("ACOUSTID_API_KEY")
-        if not api_key:
-            raise RuntimeError("Missing ACOUSTID_API_KEY env var")
-
-        fingerprint, duration = run_fpcalc(file_path)
-        raw_result = lookup_acoustid(fingerprint, duration, api_key)
-
-        matches = []
-        for result in raw_result.get("results", []):
-            for recording in result.get("recordings", []):
-                title = recording.get("title", "Unknown")
-                artist = "Unknown"
-                if recording.get("artists"):
-                    artist = recording["artists"][0].get("name", "Unknown")
-                matches.append({"title": title, "artist": artist})
+        fingerprint, duration = await run_fpcalc(file_path)
+        raw_result = await lookup_acoustid(fingerprint, duration)
+        matches = parse_matches(raw_result)
         
         logger.info("🟦Identified Successfully")
         return JSONResponse({
@@ -146,3 +453,27 @@ async def identify(file_path: str = Form(...)):
 
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@app.post("/analyze")
+async def analyze(file_path: str = Form(...), output_format: str = Form("")):
+    """
+    /convert + /identify in one decode. output_format ("flac:44100:2") is whatever
+    the next audio stage declared it reads; leave it empty when no later stage
+    needs the audio, and file_path comes back null.
+    """
+    try:
+        parse_format(output_format) if output_format else None
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    try:
+        logger.info("🟦Analyzing")
+        result = await analyze_audio(file_path, output_format)
+        logger.info("🟦Analyzed Successfully")
+        return JSONResponse(result)
+    except UnusableAudio as e:
+        logger.error(e)
+        return JSONResponse({"error": str(e)}, status_code=422)
+    except Exception as e:
+        logger.error(e)
+        return JSONResponse({"error": str(e)}, status_code=500)
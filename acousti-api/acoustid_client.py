@@ -0,0 +1,288 @@
+"""
+AcoustID lookups: a persistent on-disk cache, a token bucket held to AcoustID's
+request rate, and batching of whatever fingerprints queue up behind it into one
+multi-fingerprint lookup. Repeat identifications are answered from the cache.
+
+Point ACOUSTID_URL at acoustid_stub.py to exercise it without the real API.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+logger = logging.getLogger("acousti")
+
+ACOUSTID_URL = os.getenv("ACOUSTID_URL", "https://api.acoustid.org/v2/lookup")
+ACOUSTID_TIMEOUT_SECS = float(os.getenv("ACOUSTID_TIMEOUT_SECS", "15"))
+# AcoustID allows 3 requests/sec per client key. Stay a little under it and don't
+# burst, so network jitter can't bunch requests into one second; batching makes up
+# the throughput. A batch that still gets rate limited is resent, not failed.
+ACOUSTID_RATE = float(os.getenv("ACOUSTID_RATE", "2.5"))
+ACOUSTID_BURST = int(os.getenv("ACOUSTID_BURST", "1"))
+ACOUSTID_RATE_LIMIT_RETRIES = int(os.getenv("ACOUSTID_RATE_LIMIT_RETRIES", "3"))
+# fingerprints per batched request, and how long a lone lookup waits for company
+ACOUSTID_BATCH_SIZE = int(os.getenv("ACOUSTID_BATCH_SIZE", "10"))
+ACOUSTID_BATCH_WAIT_SECS = float(os.getenv("ACOUSTID_BATCH_WAIT_SECS", "0.05"))
+
+ACOUSTID_CACHE_PATH = os.getenv("ACOUSTID_CACHE_PATH", "/shared_data/cache/acoustid.sqlite3")
+# recordings rarely change once matched; a miss is re-asked sooner in case it gets submitted
+ACOUSTID_CACHE_TTL_SECS = float(os.getenv("ACOUSTID_CACHE_TTL_SECS", str(30 * 86400)))
+ACOUSTID_CACHE_MISS_TTL_SECS = float(os.getenv("ACOUSTID_CACHE_MISS_TTL_SECS", str(86400)))
+
+
+class RateLimited(RuntimeError):
+    pass
+
+
+def lookup_key(fingerprint: str, duration: int) -> str:
+    # fingerprints run to kilobytes; the key only needs to tell them apart
+    return hashlib.blake2b(f"{int(duration)}:{fingerprint}".encode(), digest_size=16).hexdigest()
+
+
+class LookupCache:
+    """
+    AcoustID results in SQLite, keyed by fingerprint + duration, with a TTL.
+    Survives restarts and is shared by every worker on the box. Calls are quick
+    but still disk I/O, so the async wrappers run them off the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS lookups ("
+                " key TEXT PRIMARY KEY,"
+                " result TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            self._db = db
+        return self._db
+
+    def _get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT result FROM lookups WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _put(self, key: str, result: dict) -> None:
+        ttl = ACOUSTID_CACHE_TTL_SECS if result.get("results") else ACOUSTID_CACHE_MISS_TTL_SECS
+        with self._lock:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO lookups (key, result, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(result), time.time() + ttl),
+            )
+
+    def _purge(self) -> int:
+        with self._lock:
+            return self._conn().execute(
+                "DELETE FROM lookups WHERE expires_at <= ?", (time.time(),)
+            ).rowcount
+
+    async def get(self, key: str) -> Optional[dict]:
+        result = await asyncio.to_thread(self._get, key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    async def put(self, key: str, result: dict) -> None:
+        await asyncio.to_thread(self._put, key, result)
+
+    async def purge(self) -> int:
+        return await asyncio.to_thread(self._purge)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+class TokenBucket:
+    """`rate` tokens a second, up to `burst` saved up."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:  # first come, first served
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AcoustIDClient:
+    """
+    Async lookups through one keep-alive connection. Cache misses go on a queue;
+    a single sender takes a token, then sends everything queued (up to
+    ACOUSTID_BATCH_SIZE) as one batch lookup. Identical fingerprints in flight
+    share one request.
+    """
+
+    def __init__(self, api_key: Optional[str], cache: LookupCache):
+        self.api_key = api_key
+        self.cache = cache
+        self.bucket = TokenBucket(ACOUSTID_RATE, ACOUSTID_BURST)
+        self.requests = 0
+        self.batched = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._queue: "asyncio.Queue[Tuple[str, str, int]]" = asyncio.Queue()
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._sender: Optional[asyncio.Task] = None
+
+    async def lookup(self, fingerprint: str, duration: int) -> dict:
+        """The AcoustID response for one fingerprint: {"results": [...]}."""
+        key = lookup_key(fingerprint, duration)
+        cached = await self.cache.get(key)
+        if cached is not None:
+            return cached
+        fut = self._pending.get(key)
+        if fut is None:
+            if not self.api_key:
+                raise RuntimeError("Missing ACOUSTID_API_KEY env var")
+            fut = asyncio.get_running_loop().create_future()
+            self._pending[key] = fut
+            self._queue.put_nowait((key, fingerprint, int(duration)))
+            if self._sender is None or self._sender.done():
+                self._sender = asyncio.create_task(self._send_loop())
+        # shielded: one caller giving up mustn't cancel the lookup for the others
+        return await asyncio.shield(fut)
+
+    async def _send_loop(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + ACOUSTID_BATCH_WAIT_SECS
+            while len(batch) < ACOUSTID_BATCH_SIZE:
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self._queue.get(), max(0, deadline - time.monotonic()))
+                    )
+                except asyncio.TimeoutError:
+                    break
+            try:
+                results = await self._send(batch)
+            except Exception as e:
+                self.errors += 1
+                logger.warning("AcoustID lookup of %d fingerprint(s) failed: %s", len(batch), e)
+                results = {key: e for key, _, _ in batch}
+            for key, _, _ in batch:
+                fut = self._pending.pop(key, None)
+                if fut is None or fut.done():
+                    continue
+                result = results.get(key)
+                if isinstance(result, Exception):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result if result is not None else {"results": []})
+
+    async def _send(self, batch: List[Tuple[str, str, int]]) -> Dict[str, dict]:
+        for attempt in range(ACOUSTID_RATE_LIMIT_RETRIES + 1):
+            await self.bucket.acquire()
+            # whatever queued while we waited for the token rides along; then send
+            # straight away, so requests go out as evenly spaced as the tokens
+            while len(batch) < ACOUSTID_BATCH_SIZE and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                return await self._request(batch)
+            except RateLimited:
+                if attempt == ACOUSTID_RATE_LIMIT_RETRIES:
+                    raise
+                self.rate_limited += 1
+                await asyncio.sleep(1)
+
+    async def _request(self, batch: List[Tuple[str, str, int]]) -> Dict[str, dict]:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=ACOUSTID_TIMEOUT_SECS,
+                limits=httpx.Limits(max_connections=2, max_keepalive_connections=2, keepalive_expiry=60),
+            )
+        data = {"client": self.api_key, "format": "json", "meta": "recordings"}
+        if len(batch) == 1:
+            _, fingerprint, duration = batch[0]
+            data.update(fingerprint=fingerprint, duration=str(duration))
+        else:
+            # batch form: fingerprint.N / duration.N, answered per index
+            for i, (_, fingerprint, duration) in enumerate(batch):
+                data[f"fingerprint.{i}"] = fingerprint
+                data[f"duration.{i}"] = str(duration)
+        self.requests += 1
+        self.batched += len(batch)
+        r = await self._client.post(ACOUSTID_URL, data=data)
+        body = r.json() if r.headers.get("content-type", "").startswith("application/json") else {}
+        if r.status_code == 429:
+            raise RateLimited(f"AcoustID rate limit: {body.get('error') or r.text[:300]}")
+        if r.status_code != 200 or body.get("status") != "ok":
+            raise RuntimeError(f"AcoustID error: HTTP {r.status_code} - {body.get('error') or r.text[:300]}")
+
+        if len(batch) == 1:
+            answers = {batch[0][0]: {"results": body.get("results", [])}}
+        else:
+            by_index = {str(fp.get("index")): fp.get("results", []) for fp in body.get("fingerprints", [])}
+            answers = {key: {"results": by_index.get(str(i), [])} for i, (key, _, _) in enumerate(batch)}
+        for key, result in answers.items():
+            await self.cache.put(key, result)
+        return answers
+
+    async def close(self) -> None:
+        if self._sender is not None:
+            self._sender.cancel()
+            try:
+                await self._sender
+            except asyncio.CancelledError:
+                pass
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(RuntimeError("AcoustID client closed"))
+        self._pending.clear()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self.cache.close()
+
+    def stats(self) -> dict:
+        return {
+            "cache": self.cache.stats(),
+            "requests": self.requests,
+            "fingerprints_sent": self.batched,
+            "queued": self._queue.qsize(),
+            "rate_limited": self.rate_limited,
+            "errors": self.errors,
+        }
@@ -0,0 +1,83 @@
+"""
+Stand-in for api.acoustid.org's /v2/lookup, for running acousti-api without the
+real service (or a key). Accepts the single and the batch (fingerprint.N /
+duration.N) forms, answers deterministically from the fingerprint, and enforces
+the same per-second rate limit so limiter mistakes show up as errors.
+
+    uvicorn acoustid_stub:app --port 8099
+    ACOUSTID_URL=http://localhost:8099/v2/lookup ACOUSTID_API_KEY=stub uvicorn acousti_runner:app
+
+GET /stats shows how many requests and fingerprints actually reached it.
+"""
+import hashlib
+import os
+import time
+from collections import deque
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+STUB_RATE_LIMIT = int(os.getenv("STUB_RATE_LIMIT", "3"))  # requests per rolling second
+# roughly 1 in N fingerprints comes back with no match
+STUB_MISS_EVERY = int(os.getenv("STUB_MISS_EVERY", "4"))
+
+app = FastAPI()
+_recent = deque()
+_stats = {"requests": 0, "fingerprints": 0, "rate_limited": 0}
+
+
+def _results(fingerprint: str, duration: str):
+    digest = hashlib.blake2b(fingerprint.encode(), digest_size=8).hexdigest()
+    if int(digest, 16) % STUB_MISS_EVERY == 0:
+        return []
+    return [{
+        "id": f"stub-{digest}",
+        "score": 0.97,
+        "recordings": [{
+            "id": f"rec-{digest}",
+            "title": f"Stub Song {digest[:6]}",
+            "duration": int(float(duration or 0)),
+            "artists": [{"id": f"art-{digest[:4]}", "name": f"Stub Artist {digest[:4]}"}],
+        }],
+    }]
+
+
+def _error(status: int, message: str):
+    return JSONResponse({"status": "error", "error": {"message": message}}, status_code=status)
+
+
+@app.post("/v2/lookup")
+async def lookup(request: Request):
+    now = time.monotonic()
+    while _recent and now - _recent[0] >= 1:
+        _recent.popleft()
+    if len(_recent) >= STUB_RATE_LIMIT:
+        _stats["rate_limited"] += 1
+        return _error(429, "rate limit exceeded")
+    _recent.append(now)
+    _stats["requests"] += 1
+
+    form = await request.form()
+    if not form.get("client"):
+        return _error(400, "missing required parameter \"client\"")
+
+    if "fingerprint" in form:
+        _stats["fingerprints"] += 1
+        return {"status": "ok", "results": _results(form["fingerprint"], form.get("duration"))}
+
+    indexes = sorted(k.split(".", 1)[1] for k in form if k.startswith("fingerprint."))
+    if not indexes:
+        return _error(400, "missing required parameter \"fingerprint\"")
+    _stats["fingerprints"] += len(indexes)
+    return {
+        "status": "ok",
+        "fingerprints": [
+            {"index": i, "results": _results(form[f"fingerprint.{i}"], form.get(f"duration.{i}"))}
+            for i in indexes
+        ],
+    }
+
+
+@app.get("/stats")
+async def stats():
+    return _stats
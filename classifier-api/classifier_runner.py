@@ -6,6 +6,7 @@ from typing import Optional, Dict, Any
 from fastapi import FastAPI, HTTPException, Body, Form
 from pydantic import BaseModel
 import httpx
+from contextlib import asynccontextmanager
 
 # ----------------------------
 # Logging
@@ -41,6 +42,10 @@ AI_TEMPERATURE = float(os.getenv("AI_TEMPERATURE", "0"))
 AI_NUM_CTX = int(os.getenv("AI_NUM_CTX", "4096"))
 AI_TIMEOUT_SECS = float(os.getenv("AI_TIMEOUT_SECS", "120"))
 
+# One keep-alive pool to the model server for the life of the process
+# (Ollama serves a handful of generations at once; more just queue there)
+AI_MAX_CONNECTIONS = int(os.getenv("AI_MAX_CONNECTIONS", "4"))
+
 # ----------------------------
 # Prompts
 # ----------------------------
@@ -60,10 +65,31 @@ Return STRICT JSON with keys:
 No extra text or markdown fences — JSON only.
 """
 
+# ----------------------------
+# HTTP client
+# ----------------------------
+_llm_client = httpx.AsyncClient(
+    timeout=AI_TIMEOUT_SECS,
+    limits=httpx.Limits(
+        max_connections=AI_MAX_CONNECTIONS,
+        max_keepalive_connections=AI_MAX_CONNECTIONS,
+        keepalive_expiry=60,
+    ),
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        yield
+    finally:
+        await _llm_client.aclose()
+
+
 # ----------------------------
 # FastAPI app
 # ----------------------------
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
 class LyricsInput(BaseModel):
@@ -78,19 +104,18 @@ async def health():
 @app.get("/health/llm")
 async def llm_health():
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            if AI_PROVIDER == "ollama":
-                r = await client.get(f"{AI_BASE_URL}/api/tags")
-                ok = r.status_code == 200
-                body = r.json() if ok else {"status_code": r.status_code}
-                return {"ok": ok, "provider": "ollama", "models": body}
-            else:
-                # OpenAI/LocalAI-compatible
-                headers = _auth_header()
-                r = await client.get(f"{AI_BASE_URL}/models", headers=headers)
-                ok = r.status_code == 200
-                body = r.json() if ok else {"status_code": r.status_code}
-                return {"ok": ok, "provider": "openai", "models": body}
+        if AI_PROVIDER == "ollama":
+            r = await _llm_client.get(f"{AI_BASE_URL}/api/tags", timeout=10)
+            ok = r.status_code == 200
+            body = r.json() if ok else {"status_code": r.status_code}
+            return {"ok": ok, "provider": "ollama", "models": body}
+        else:
+            # OpenAI/LocalAI-compatible
+            headers = _auth_header()
+            r = await _llm_client.get(f"{AI_BASE_URL}/models", headers=headers, timeout=10)
+            ok = r.status_code == 200
+            body = r.json() if ok else {"status_code": r.status_code}
+            return {"ok": ok, "provider": "openai", "models": body}
     except Exception as e:
         return {"ok": False, "provider": AI_PROVIDER, "error": str(e), "base_url": AI_BASE_URL}
 
@@ -120,16 +145,15 @@ async def _ask_llm(lyrics: str) -> Dict[str, Any]:
             "messages": [sys_msg, user_msg],
             "options": {"temperature": AI_TEMPERATURE, "num_ctx": AI_NUM_CTX},
         }
-        async with httpx.AsyncClient(timeout=AI_TIMEOUT_SECS) as client:
-            res = await client.post(f"{AI_BASE_URL}/api/chat", json=payload)
-            try:
-                res.raise_for_status()
-            except httpx.HTTPStatusError as e:
-                logger.error("Ollama error: %s | body=%s", e, getattr(e.response, "text", "")[:500])
-                logger.info(e)
-                raise HTTPException(status_code=502, detail="Model server error (ollama)")
-            j = res.json()
-            content = (j.get("message") or {}).get("content", "").strip()
+        res = await _llm_client.post(f"{AI_BASE_URL}/api/chat", json=payload)
+        try:
+            res.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            logger.error("Ollama error: %s | body=%s", e, getattr(e.response, "text", "")[:500])
+            logger.info(e)
+            raise HTTPException(status_code=502, detail="Model server error (ollama)")
+        j = res.json()
+        content = (j.get("message") or {}).get("content", "").strip()
     # else:
     #     # OpenAI/LocalAI-compatible
     #     payload = {
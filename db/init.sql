@@ -10,16 +10,48 @@ CREATE TABLE IF NOT EXISTS songs (
   duration INTEGER,
   fingerprint TEXT,
   fingerprint_hash TEXT UNIQUE,     -- natural key for dedupe/upsert
+  fp_subfingerprints BYTEA,         -- decoded Chromaprint print, little-endian uint32s (near-duplicate index)
+  content_hash TEXT,                -- sha256 of the upload this song was first built from
   audio_processed BOOLEAN DEFAULT FALSE,
   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  -- normalized copies for fuzzy search (trigram GiST indexes below)
+  title_norm  TEXT GENERATED ALWAYS AS (lower(title)) STORED,
+  artist_norm TEXT GENERATED ALWAYS AS (lower(COALESCE(artist, ''))) STORED
 );
 
 CREATE INDEX IF NOT EXISTS idx_songs_hash ON songs(fingerprint_hash);
 
+-- byte-identical re-uploads are answered from here without touching acousti
+CREATE INDEX IF NOT EXISTS idx_songs_content_hash ON songs(content_hash);
+
+-- keyset pagination for GET /api/songs: ORDER BY created_at DESC, id DESC
+CREATE INDEX IF NOT EXISTS idx_songs_created_id ON songs(created_at DESC, id DESC);
+
+
+-- orchestrator replicas cache song rows in memory; tell them when one changes.
+-- the trigger argument is the channel and must match SONGS_CHANNEL in orchestrator-api/db.py
+CREATE OR REPLACE FUNCTION notify_song_change() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify(TG_ARGV[0], json_build_object(
+    'id', OLD.id, 'fingerprint_hash', OLD.fingerprint_hash, 'op', TG_OP
+  )::text);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER songs_notify_change
+  AFTER UPDATE OR DELETE ON songs
+  FOR EACH ROW EXECUTE FUNCTION notify_song_change('songs');
+
 
 CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
+-- search_song_fuzzy: GiST (not GIN) so the same index serves both the `%` threshold
+-- filter and `<->` KNN ordering
+CREATE INDEX IF NOT EXISTS idx_songs_title_trgm  ON songs USING gist (title_norm gist_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_songs_artist_trgm ON songs USING gist (artist_norm gist_trgm_ops);
+
 drop table jobs;
 
 
@@ -38,6 +70,8 @@ CREATE TABLE jobs (
   duration         INTEGER,
   fingerprint      TEXT,
   fingerprint_hash TEXT,     -- natural key for dedupe/upsert
+  fp_subfingerprints BYTEA,  -- decoded print, copied to songs on completion
+  content_hash     TEXT,     -- sha256 of the uploaded bytes
   audio_processed  BOOLEAN DEFAULT FALSE,
   want_identify    BOOLEAN NOT NULL DEFAULT FALSE,
   want_demucs      BOOLEAN NOT NULL DEFAULT FALSE,
@@ -46,5 +80,198 @@ CREATE TABLE jobs (
   done_identify    BOOLEAN NOT NULL DEFAULT FALSE,
   done_demucs      BOOLEAN NOT NULL DEFAULT FALSE,
   done_whisper     BOOLEAN NOT NULL DEFAULT FALSE,
-  done_classify    BOOLEAN NOT NULL DEFAULT FALSE
-);
\ No newline at end of file
+  done_classify    BOOLEAN NOT NULL DEFAULT FALSE,
+  claimed_at       TIMESTAMPTZ,      -- when the current stage was claimed
+  lease_expires_at TIMESTAMPTZ,      -- worker heartbeats push this forward; reaper requeues once it passes
+  attempts         INTEGER NOT NULL DEFAULT 0,  -- failed tries of the current stage, reset when it succeeds
+  next_attempt_at  TIMESTAMPTZ,      -- backoff: not claimable before this
+  last_error       TEXT,
+  leader_job_id    BIGINT,           -- single-flight: while 'Waiting', the job for the same fingerprint doing our stages
+  created_at       TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at       TIMESTAMPTZ NOT NULL DEFAULT now(),
+  -- first wanted-but-not-done stage; NULL once nothing is left
+  next_stage       TEXT GENERATED ALWAYS AS (
+    CASE
+      WHEN want_identify AND NOT done_identify THEN 'identify'
+      WHEN want_demucs   AND NOT done_demucs   THEN 'demucs'
+      WHEN want_whisper  AND NOT done_whisper  THEN 'whisper'
+      WHEN want_classify AND NOT done_classify THEN 'classify'
+    END
+  ) STORED
+);
+
+-- only runnable jobs live in this index, so claiming stays cheap however much history piles up.
+-- the predicate must match RUNNABLE_STATUSES in orchestrator-api/db.py
+CREATE INDEX IF NOT EXISTS idx_jobs_runnable ON jobs(next_stage, id)
+  WHERE status IN ('Not Started','Queued','In Progress') AND next_stage IS NOT NULL;
+
+-- lets /api/analyze attach a byte-identical upload to a job that is still running
+CREATE INDEX IF NOT EXISTS idx_jobs_content_hash_live ON jobs(content_hash)
+  WHERE status IN ('Not Started','Queued','In Progress','Claimed','Waiting');
+
+-- single-flight: identify looks for a live leader with the same fingerprint ...
+CREATE INDEX IF NOT EXISTS idx_jobs_fp_leader ON jobs(fingerprint_hash)
+  WHERE leader_job_id IS NULL AND status IN ('Not Started','Queued','In Progress','Claimed');
+
+-- ... and the leader's completion/death finds the jobs waiting on it
+CREATE INDEX IF NOT EXISTS idx_jobs_followers ON jobs(leader_job_id) WHERE status = 'Waiting';
+
+-- lets the reaper find expired leases without scanning history
+CREATE INDEX IF NOT EXISTS idx_jobs_lease ON jobs(lease_expires_at) WHERE status = 'Claimed';
+
+-- keep jobs.updated_at current on every write
+CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger AS $$
+BEGIN
+  NEW.updated_at = now();
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER jobs_touch_updated_at
+  BEFORE UPDATE ON jobs
+  FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+
+-- songs.updated_at drives the ETag / Last-Modified of GET /api/songs/{id}
+CREATE TRIGGER songs_touch_updated_at
+  BEFORE UPDATE ON songs
+  FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+
+
+-- Records one stage's result and, if that was the last wanted stage, promotes the job
+-- into songs and marks it Completed -- all in one call/transaction (one round trip per stage).
+-- Jobs 'Waiting' on this one (single-flight followers) are completed with its results too.
+-- p_fields is a JSON object of jobs columns to set; keys that are absent are left alone.
+-- Returns the song id when the job completed, else NULL. NOTIFYs p_channel either way.
+CREATE OR REPLACE FUNCTION complete_stage(p_job_id BIGINT, p_fields JSONB, p_channel TEXT)
+RETURNS INTEGER AS $$
+DECLARE
+  j jobs;
+  f RECORD;
+  v_song_id INTEGER;
+BEGIN
+  UPDATE jobs t SET
+    song_id          = CASE WHEN p_fields ? 'song_id'          THEN r.song_id          ELSE t.song_id END,
+    current_stage    = CASE WHEN p_fields ? 'current_stage'    THEN r.current_stage    ELSE t.current_stage END,
+    status           = CASE WHEN p_fields ? 'status'           THEN r.status           ELSE t.status END,
+    title            = CASE WHEN p_fields ? 'title'            THEN r.title            ELSE t.title END,
+    artist           = CASE WHEN p_fields ? 'artist'           THEN r.artist           ELSE t.artist END,
+    lyrics           = CASE WHEN p_fields ? 'lyrics'           THEN r.lyrics           ELSE t.lyrics END,
+    classification   = CASE WHEN p_fields ? 'classification'   THEN r.classification   ELSE t.classification END,
+    accuracy         = CASE WHEN p_fields ? 'accuracy'         THEN r.accuracy         ELSE t.accuracy END,
+    file_path        = CASE WHEN p_fields ? 'file_path'        THEN r.file_path        ELSE t.file_path END,
+    duration         = CASE WHEN p_fields ? 'duration'         THEN r.duration         ELSE t.duration END,
+    fingerprint      = CASE WHEN p_fields ? 'fingerprint'      THEN r.fingerprint      ELSE t.fingerprint END,
+    fingerprint_hash = CASE WHEN p_fields ? 'fingerprint_hash' THEN r.fingerprint_hash ELSE t.fingerprint_hash END,
+    fp_subfingerprints = CASE WHEN p_fields ? 'fp_subfingerprints' THEN r.fp_subfingerprints ELSE t.fp_subfingerprints END,
+    audio_processed  = CASE WHEN p_fields ? 'audio_processed'  THEN r.audio_processed  ELSE t.audio_processed END,
+    done_identify    = CASE WHEN p_fields ? 'done_identify'    THEN r.done_identify    ELSE t.done_identify END,
+    done_demucs      = CASE WHEN p_fields ? 'done_demucs'      THEN r.done_demucs      ELSE t.done_demucs END,
+    done_whisper     = CASE WHEN p_fields ? 'done_whisper'     THEN r.done_whisper     ELSE t.done_whisper END,
+    done_classify    = CASE WHEN p_fields ? 'done_classify'    THEN r.done_classify    ELSE t.done_classify END,
+    claimed_at       = CASE WHEN p_fields ? 'claimed_at'       THEN r.claimed_at       ELSE t.claimed_at END,
+    lease_expires_at = CASE WHEN p_fields ? 'lease_expires_at' THEN r.lease_expires_at ELSE t.lease_expires_at END,
+    attempts         = CASE WHEN p_fields ? 'attempts'         THEN r.attempts         ELSE t.attempts END,
+    next_attempt_at  = CASE WHEN p_fields ? 'next_attempt_at'  THEN r.next_attempt_at  ELSE t.next_attempt_at END,
+    last_error       = CASE WHEN p_fields ? 'last_error'       THEN r.last_error       ELSE t.last_error END,
+    leader_job_id    = CASE WHEN p_fields ? 'leader_job_id'    THEN r.leader_job_id    ELSE t.leader_job_id END
+  FROM jsonb_populate_record(NULL::jobs, p_fields) r
+  WHERE t.id = p_job_id
+  RETURNING t.* INTO j;
+
+  IF NOT FOUND THEN
+    RETURN NULL;
+  END IF;
+
+  -- every wanted stage done (same rule as the generated next_stage column)
+  IF j.next_stage IS NULL AND j.status <> 'Completed' THEN
+    INSERT INTO songs (
+      title, artist, duration, fingerprint, fingerprint_hash,
+      lyrics, classification, accuracy, file_path, audio_processed, content_hash,
+      fp_subfingerprints
+    )
+    VALUES (
+      j.title, j.artist, j.duration, j.fingerprint, j.fingerprint_hash,
+      j.lyrics, j.classification, j.accuracy, j.file_path, COALESCE(j.audio_processed, FALSE),
+      j.content_hash, j.fp_subfingerprints
+    )
+    ON CONFLICT (fingerprint_hash) DO UPDATE SET
+      title          = COALESCE(EXCLUDED.title, songs.title),
+      artist         = COALESCE(EXCLUDED.artist, songs.artist),
+      duration       = COALESCE(EXCLUDED.duration, songs.duration),
+      fingerprint    = COALESCE(EXCLUDED.fingerprint, songs.fingerprint),
+      lyrics         = COALESCE(EXCLUDED.lyrics, songs.lyrics),
+      classification = COALESCE(EXCLUDED.classification, songs.classification),
+      accuracy       = COALESCE(EXCLUDED.accuracy, songs.accuracy),
+      file_path      = COALESCE(EXCLUDED.file_path, songs.file_path),
+      content_hash   = COALESCE(songs.content_hash, EXCLUDED.content_hash),
+      fp_subfingerprints = COALESCE(songs.fp_subfingerprints, EXCLUDED.fp_subfingerprints),
+      audio_processed = (EXCLUDED.audio_processed OR songs.audio_processed)
+    RETURNING id INTO v_song_id;
+
+    UPDATE jobs
+    SET status  = 'Completed',
+        song_id = COALESCE(v_song_id, song_id)
+    WHERE id = p_job_id
+    RETURNING * INTO j;
+
+    -- followers only wait for stages the leader wants, so it has everything they need
+    FOR f IN
+      UPDATE jobs w SET
+        song_id        = v_song_id,
+        file_path      = CASE WHEN w.want_demucs AND NOT w.done_demucs THEN j.file_path ELSE w.file_path END,
+        lyrics         = CASE WHEN w.want_whisper AND NOT w.done_whisper THEN j.lyrics ELSE w.lyrics END,
+        classification = CASE WHEN w.want_classify AND NOT w.done_classify THEN j.classification ELSE w.classification END,
+        accuracy       = CASE WHEN w.want_classify AND NOT w.done_classify THEN j.accuracy ELSE w.accuracy END,
+        done_demucs    = w.done_demucs OR w.want_demucs,
+        done_whisper   = w.done_whisper OR w.want_whisper,
+        done_classify  = w.done_classify OR w.want_classify,
+        status         = 'Completed',
+        leader_job_id  = NULL
+      WHERE w.leader_job_id = p_job_id AND w.status = 'Waiting'
+      RETURNING w.id, w.status, w.current_stage, w.next_stage, w.song_id
+    LOOP
+      PERFORM pg_notify(p_channel, row_to_json(f)::text);
+    END LOOP;
+  END IF;
+
+  PERFORM pg_notify(p_channel, json_build_object(
+    'id', j.id, 'status', j.status, 'current_stage', j.current_stage,
+    'next_stage', j.next_stage, 'song_id', j.song_id
+  )::text);
+
+  RETURN v_song_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- A leader that was dead-lettered or failed hands its followers back to the queue so each
+-- runs its own remaining stages. Returns how many were released; NOTIFYs p_channel for each.
+CREATE OR REPLACE FUNCTION release_followers(p_leader_id BIGINT, p_channel TEXT)
+RETURNS INTEGER AS $$
+DECLARE
+  f RECORD;
+  n INTEGER := 0;
+BEGIN
+  FOR f IN
+    UPDATE jobs
+    SET status = 'Queued', leader_job_id = NULL
+    WHERE leader_job_id = p_leader_id AND status = 'Waiting'
+    RETURNING id, status, current_stage, next_stage, song_id
+  LOOP
+    PERFORM pg_notify(p_channel, row_to_json(f)::text);
+    n := n + 1;
+  END LOOP;
+  RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+-- finished jobs are moved here by the orchestrator's archiver so `jobs` only holds live work.
+-- same columns as jobs (next_stage becomes a plain column), monthly partitions by archived_at;
+-- the archiver creates upcoming partitions and drops ones past JOB_RETENTION_DAYS
+CREATE TABLE IF NOT EXISTS jobs_archive (
+  LIKE jobs,
+  archived_at TIMESTAMPTZ NOT NULL DEFAULT now()
+) PARTITION BY RANGE (archived_at);
+
+CREATE TABLE IF NOT EXISTS jobs_archive_default PARTITION OF jobs_archive DEFAULT;
+
+CREATE INDEX IF NOT EXISTS idx_jobs_archive_id ON jobs_archive(id);
@@ -0,0 +1,28 @@
+-- Schema changes for databases created from an older init.sql.
+--
+-- init.sql only runs when the pgdata volume is empty, so every column, index or
+-- function a later change adds to it must also be added here, idempotently
+-- (ADD COLUMN IF NOT EXISTS, CREATE INDEX IF NOT EXISTS, CREATE OR REPLACE).
+-- Append to the end; never edit a block that has shipped.
+--
+-- docker compose runs this on every start (the db_migrate service). By hand:
+--   docker compose exec -T db psql -U $POSTGRES_USER -d $POSTGRES_DB -v ON_ERROR_STOP=1 < db/migrations.sql
+
+
+-- content-hash dedupe of byte-identical uploads
+ALTER TABLE songs ADD COLUMN IF NOT EXISTS content_hash TEXT;
+CREATE INDEX IF NOT EXISTS idx_songs_content_hash ON songs(content_hash);
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS content_hash TEXT;
+CREATE INDEX IF NOT EXISTS idx_jobs_content_hash_live ON jobs(content_hash)
+  WHERE status IN ('Not Started','Queued','In Progress','Claimed','Waiting');
+
+-- fuzzy song search: normalized copies + trigram GiST indexes (see init.sql)
+ALTER TABLE songs ADD COLUMN IF NOT EXISTS title_norm  TEXT GENERATED ALWAYS AS (lower(title)) STORED;
+ALTER TABLE songs ADD COLUMN IF NOT EXISTS artist_norm TEXT GENERATED ALWAYS AS (lower(COALESCE(artist, ''))) STORED;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS idx_songs_title_trgm  ON songs USING gist (title_norm gist_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_songs_artist_trgm ON songs USING gist (artist_norm gist_trgm_ops);
+
+-- near-duplicate matching: decoded Chromaprint prints (see fingerprints.py)
+ALTER TABLE songs ADD COLUMN IF NOT EXISTS fp_subfingerprints BYTEA;
+ALTER TABLE jobs  ADD COLUMN IF NOT EXISTS fp_subfingerprints BYTEA;
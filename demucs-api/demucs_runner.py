@@ -6,7 +6,7 @@ import soundfile as sf
 from fastapi.responses import JSONResponse
 from demucs.apply import apply_model
 from demucs.pretrained import get_model
-from demucs.audio import AudioFile
+from demucs.audio import AudioFile, convert_audio
 
 import logging
 
@@ -21,16 +21,32 @@ MODEL = get_model(name="htdemucs")
 OUTPUT_DIR = Path("/shared_data/stems")
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# stems are written as "codec:rate:channels"; the orchestrator asks for whatever
+# whisper declared, so it never has to resample or downmix them again
+STEM_CODECS = {"flac": ("flac", "FLAC"), "wav": ("wav", "WAV")}
+DEFAULT_STEM_FORMAT = f"wav:{MODEL.samplerate}:{MODEL.audio_channels}"
 
-def separate_vocals(file_path: str, output_path: str):
-    ref = AudioFile(file_path).read(streams=0, samplerate=MODEL.samplerate)
+
+def parse_format(spec: str):
+    """'flac:16000:1' -> (extension, soundfile format, rate, channels)."""
+    try:
+        codec, rate, channels = spec.split(":")
+        ext, sf_format = STEM_CODECS[codec]
+        return ext, sf_format, int(rate), int(channels)
+    except (KeyError, ValueError):
+        raise ValueError(f"bad output_format {spec!r}, expected codec:rate:channels")
+
+
+def separate_vocals(file_path: str, output_path: str, sf_format: str, rate: int, channels: int):
+    ref = AudioFile(file_path).read(streams=0, samplerate=MODEL.samplerate, channels=MODEL.audio_channels)
     ref = ref.unsqueeze(0)
     sources = apply_model(MODEL, ref, split=True, overlap=0.25)[0]
 
     for idx, name in enumerate(MODEL.sources):
         if name == "vocals":
             stem = sources[idx].squeeze(0) if sources[idx].ndim == 3 else sources[idx]
-            sf.write(output_path, stem.T.cpu().numpy(), MODEL.samplerate)
+            stem = convert_audio(stem, MODEL.samplerate, rate, channels)
+            sf.write(output_path, stem.T.cpu().numpy(), rate, format=sf_format, subtype="PCM_16")
             return True
     return False
 
@@ -39,14 +55,24 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/format")
+async def input_format():
+    # what the model runs at; anything else gets resampled on read
+    return {"codec": "flac", "rate": MODEL.samplerate, "channels": MODEL.audio_channels}
+
+
 @app.post("/separate")
-async def separate(file_path: str = Form(...)):
+async def separate(file_path: str = Form(...), output_format: str = Form(DEFAULT_STEM_FORMAT)):
     logger.info("🟦Separating Stems")
+    try:
+        ext, sf_format, rate, channels = parse_format(output_format)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
     base = os.path.basename(file_path)
-    output_path = f"/shared_data/stems/{base}.wav"
+    output_path = f"/shared_data/stems/{base}.{ext}"
 
     try:
-        success = separate_vocals(str(file_path), output_path)
+        success = separate_vocals(str(file_path), output_path, sf_format, rate, channels)
         os.remove(file_path)
 
         if success:
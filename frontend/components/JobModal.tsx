@@ -30,31 +30,50 @@ export default function JobModal({ jobModalOpen, setJobModalOpen, jobId, handleC
   useEffect(() => {
     if (!jobModalOpen || !jobId) return;
 
+    // the stream ends after these; don't treat that close as an error
+    let finished = false;
+
+    const apply = (data: JobRow) => {
+      finished = ['Completed', 'Failed', 'Dead'].includes(data.status);
+      const key = (data.current_stage ?? '').toLowerCase();
+      setStageText(STAGE_VERBS[key] ?? (key || '—'));
+      setStatus(data.status ?? '—');
+      if (data.status == "Completed"){
+          console.log("switching to song view")
+          
+          handleCompleted(data.song_id);
+      }
+    };
+
     const fetchOnce = async () => {
       try {
         const res = await fetch(`/api/jobs/${jobId}`, { headers: { Accept: 'application/json' } });
         if (!res.ok) return;
         const data: JobRow = await res.json();
-        const key = (data.current_stage ?? '').toLowerCase();
-        setStageText(STAGE_VERBS[key] ?? (key || '—'));
-        setStatus(data.status ?? '—');
-        if (data.status == "Completed"){
-            console.log("switching to song view")
-            
-            handleCompleted(data.song_id);
-        }
-
-
+        apply(data);
       } catch {
         /* ignore */
       }
     };
 
-    // fetch immediately, then poll lightly
-    fetchOnce();
-    timerRef.current = setInterval(fetchOnce, 1000);
+    // server pushes stage changes; fall back to light polling if the stream can't be held
+    const source = new EventSource(`/api/jobs/${jobId}/events`);
+    source.addEventListener('job', (e) => {
+      try {
+        apply(JSON.parse((e as MessageEvent).data));
+      } catch {
+        /* ignore */
+      }
+    });
+    source.onerror = () => {
+      source.close();
+      if (finished || timerRef.current) return;
+      fetchOnce();
+      timerRef.current = setInterval(fetchOnce, 1000);
+    };
 
     return () => {
+      source.close();
       if (timerRef.current) clearInterval(timerRef.current);
       timerRef.current = null;
     };
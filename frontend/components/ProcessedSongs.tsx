@@ -1,13 +1,26 @@
 'use client';
 
 import { useState } from 'react';
-import useSWR from 'swr';
+import useSWRInfinite from 'swr/infinite';
 import SongModal from './SongModal';
 
-const fetcher = (url: string) => fetch(url).then(res => res.json());
+type SongsPage = { songs: Song[]; next: string | null };
+
+const fetchPage = async (url: string): Promise<SongsPage> => {
+  const res = await fetch(url);
+  if (!res.ok) throw new Error(`GET ${url} failed: ${res.status}`);
+  return { songs: await res.json(), next: res.headers.get('X-Next-Cursor') };
+};
+
+// /api/songs is keyset-paginated: each page's X-Next-Cursor header is the next page's ?cursor=
+export function songsPageKey(index: number, previous: SongsPage | null) {
+  if (index === 0) return '/api/songs';
+  if (!previous?.next) return null;
+  return `/api/songs?cursor=${encodeURIComponent(previous.next)}`;
+}
 
 export function useSWRSongs() {
-  return useSWR('/api/songs', fetcher, { refreshInterval: 5000 });
+  return useSWRInfinite(songsPageKey, fetchPage, { refreshInterval: 5000 });
 }
 
 type Song = {
@@ -15,6 +28,7 @@ type Song = {
   title?: string;
   artist?: string;
   lyrics?: string;
+  lyrics_preview?: string;
   classification?: string;
   accuracy?: number | string;
   fingerprint?: string;
@@ -26,17 +40,27 @@ type Props = {
 };
 
 export default function ProcessedSongs( {setSelected} : Props) {
-  const { data, error } = useSWRSongs();
+  const { data, error, size, setSize, isValidating } = useSWRSongs();
   //const [selected, setSelected] = useState<Song | null>(null);
 
   if (error) return <div>Failed to load songs</div>;
   if (!data) return <div>Loading...</div>;
 
+  // new songs shift the pages under us, so one can show up on two of them
+  const seen = new Set<Song['id']>();
+  const songs = data.flatMap(page => page.songs).filter(song => {
+    if (seen.has(song.id)) return false;
+    seen.add(song.id);
+    return true;
+  });
+  const hasMore = !!data[data.length - 1]?.next;
+  const loadingMore = isValidating && size > data.length;
+
   return (
     <div>
       <h2 className="text-xl font-bold mb-4">Processed Songs</h2>
       <div className="flex flex-col gap-4">
-        {data.map((song: Song) => (
+        {songs.map((song: Song) => (
           <button
             key={song.id}
             onClick={() => setSelected(Number(song.id))}
@@ -45,7 +69,7 @@ export default function ProcessedSongs( {setSelected} : Props) {
             <div className="font-bold text-lg">{song.title || '—'}</div>
             <div className="text-sm text-gray-300">{song.artist || '—'}</div>
             <div className="text-sm italic text-gray-400 mt-1 truncate">
-              {song.lyrics || 'No lyrics'}
+              {song.lyrics_preview || song.lyrics || 'No lyrics'}
             </div>
             <div className="text-sm mt-1">
               {song.classification || '—'}{' '}
@@ -56,6 +80,15 @@ export default function ProcessedSongs( {setSelected} : Props) {
           </button>
         ))}
       </div>
+      {hasMore && (
+        <button
+          onClick={() => setSize(size + 1)}
+          disabled={loadingMore}
+          className="mt-4 w-full p-2 rounded-lg bg-white/10 border border-white/20 text-white hover:bg-white/20 transition disabled:opacity-50"
+        >
+          {loadingMore ? 'Loading...' : 'Load more'}
+        </button>
+      )}
 
     </div>
   );
@@ -2,6 +2,8 @@
 import SongModal from './SongModal';
 import { useState } from 'react';
 import { mutate } from 'swr';
+import { unstable_serialize } from 'swr/infinite';
+import { songsPageKey } from './ProcessedSongs';
 import { useEffect } from 'react';
 import JobModal from './JobModal';
 function cn(...inputs: (string | boolean | null | undefined)[]): string {
@@ -89,12 +91,18 @@ export default function UploadForm({ setJobModalOpen, setJobId, setSelected }: P
         body: formData,
       });
       const data = await res.json();
-      if (start == "search") {
+      if (res.status === 503) {
+        // a needed stage is backed up
+        alert(data.error)
+      } else if (start == "search") {
         if (data.status == "404") {
           alert("song not found in our database")
         }
         setSelected(data.song_id)
 
+      } else if (data.song_id && !data.job_id) {
+        // exact same file was already analyzed
+        setSelected(data.song_id)
       } else {
         setJobId(data.job_id)
         setJobModalOpen(true)
@@ -107,7 +115,7 @@ export default function UploadForm({ setJobModalOpen, setJobId, setSelected }: P
       alert('Upload failed');
       console.log(err)
     } finally {
-      mutate('/api/songs');
+      mutate(unstable_serialize(songsPageKey));
       setLoading(false);
     }
   };
@@ -0,0 +1,107 @@
+"""
+Latency of search_song_fuzzy at 10k / 100k / 1M songs, old query vs the indexed one.
+
+Runs against DATABASE_URL but only touches a throwaway `bench_fuzzy` schema
+(songs cloned with LIKE ... INCLUDING ALL, so same generated columns and indexes):
+
+    DATABASE_URL=postgres://... python bench_fuzzy_search.py [--sizes 10000,100000,1000000]
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import asyncpg
+
+from db import dsn, fetch_song_fuzzy
+
+# the pre-index query, for comparison
+OLD_SQL = """
+SELECT id, title, artist,
+       similarity(LOWER(title),  LOWER($1)) +
+       similarity(LOWER(artist), LOWER($2)) AS score
+FROM songs
+ORDER BY (LOWER(title) <-> LOWER($1)) +
+         (LOWER(artist) <-> LOWER($2))
+LIMIT $3
+"""
+
+WORDS = (
+    "love night heart fire dream rain summer blue gold city road light dance wild river "
+    "shadow ghost electric midnight velvet sugar thunder paper silver broken neon ocean "
+    "highway echo stone honey wolf glass empire satellite garden mirror winter fever"
+).split()
+
+SEED_SQL = """
+INSERT INTO songs (id, title, artist, fingerprint_hash)
+SELECT
+  g,  -- explicit ids: the cloned default would still draw from public.songs_id_seq
+  initcap(w[1 + (g * 7) % n] || ' ' || w[1 + (g * 13) % n] || ' ' || w[1 + (g * 31) % n]) || ' ' || g,
+  initcap(w[1 + (g * 17) % n] || ' ' || w[1 + (g * 23) % n]),
+  'bench-' || g
+FROM generate_series($1::int, $2::int) g,
+     (SELECT $3::text[] AS w, cardinality($3::text[]) AS n) words
+"""
+
+
+def typo(s: str) -> str:
+    # drop one character so queries are near, not exact, matches
+    i = random.randrange(len(s))
+    return s[:i] + s[i + 1:]
+
+
+async def timed(search, queries):
+    """(p50, p95) in ms of `search(title, artist)` over `queries`."""
+    samples = []
+    for title, artist in queries:
+        t0 = time.perf_counter()
+        await search(title, artist)
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[max(0, int(len(samples) * 0.95) - 1)]
+
+
+async def main(sizes, runs):
+    conn = await asyncpg.connect(dsn=dsn)
+    try:
+        await conn.execute("DROP SCHEMA IF EXISTS bench_fuzzy CASCADE")
+        await conn.execute("CREATE SCHEMA bench_fuzzy")
+        await conn.execute("CREATE TABLE bench_fuzzy.songs (LIKE public.songs INCLUDING ALL)")
+        await conn.execute("SET search_path = bench_fuzzy, public")
+
+        have = 0
+        print(f"{'songs':>9} | {'old p50':>9} {'old p95':>9} | {'new p50':>9} {'new p95':>9}  (ms)")
+        for size in sizes:
+            t0 = time.perf_counter()
+            await conn.execute(SEED_SQL, have + 1, size, WORDS)
+            await conn.execute("ANALYZE bench_fuzzy.songs")
+            have = size
+            seeded = time.perf_counter() - t0
+
+            rows = await conn.fetch(
+                "SELECT title, artist FROM songs ORDER BY random() LIMIT $1", runs
+            )
+            queries = [(typo(r["title"]), typo(r["artist"])) for r in rows]
+            # the old query is a full scan + sort; keep its run count sane at 1M
+            old = await timed(
+                lambda t, a: conn.fetch(OLD_SQL, t, a, 5),
+                queries[:20] if size >= 1_000_000 else queries,
+            )
+            # exactly what the API runs, threshold included
+            new = await timed(lambda t, a: fetch_song_fuzzy(conn, t, a, 5), queries)
+            print(
+                f"{size:>9} | {old[0]:>9.1f} {old[1]:>9.1f} | {new[0]:>9.1f} {new[1]:>9.1f}"
+                f"  (seeded in {seeded:.0f}s)"
+            )
+    finally:
+        await conn.execute("DROP SCHEMA IF EXISTS bench_fuzzy CASCADE")
+        await conn.close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="10000,100000,1000000")
+    ap.add_argument("--runs", type=int, default=100)
+    a = ap.parse_args()
+    asyncio.run(main([int(x) for x in a.sizes.split(",")], a.runs))
@@ -0,0 +1,101 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+SONG_CACHE_SIZE = int(os.getenv("SONG_CACHE_SIZE", "2048"))
+SONG_CACHE_TTL_SECS = float(os.getenv("SONG_CACHE_TTL_SECS", "300"))
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Small bounded LRU with a per-entry TTL. Not thread-safe; it is only touched
+    from the event loop. The TTL bounds staleness if an invalidation is ever missed.
+
+    `generation` moves on every invalidation: read it before a DB fetch and pass it
+    to set(), so a row fetched before an invalidation can't be cached after it.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING or entry[0] < time.monotonic():
+            if entry is not _MISSING:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None) -> None:
+        if self.max_size <= 0 or (generation is not None and generation != self.generation):
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        self.generation += 1
+        if self._data.pop(key, _MISSING) is not _MISSING:
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self.generation += 1
+        self.invalidations += len(self._data)
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl_secs": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class SongCache(LRUCache):
+    """
+    Song rows keyed both by id and by fingerprint_hash. The two lookups select
+    different columns, so they are separate entries; invalidate() drops both.
+    """
+
+    def get_by_id(self, song_id: int):
+        return self.get(("id", song_id))
+
+    def get_by_fingerprint(self, fingerprint_hash: str):
+        return self.get(("fp", fingerprint_hash))
+
+    def put_by_id(self, song_id: int, row, generation: Optional[int] = None) -> None:
+        self.set(("id", song_id), row, generation)
+
+    def put_by_fingerprint(self, fingerprint_hash: str, row, generation: Optional[int] = None) -> None:
+        self.set(("fp", fingerprint_hash), row, generation)
+
+    def invalidate(self, song_id: Optional[int] = None, fingerprint_hash: Optional[str] = None) -> None:
+        if song_id is not None:
+            self.pop(("id", song_id))
+        if fingerprint_hash is not None:
+            self.pop(("fp", fingerprint_hash))
+
+
+# shared by identify and the song endpoints in this process
+SONG_CACHE = SongCache(SONG_CACHE_SIZE, SONG_CACHE_TTL_SECS)
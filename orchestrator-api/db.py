@@ -1,14 +1,35 @@
 import os
+import re
+import time
 import asyncpg
+from datetime import date
 from contextlib import asynccontextmanager
 from typing import Optional
 import json
 from utils import make_unique_key
+from cache import SONG_CACHE
 from typing import Optional, Dict, Any
 
 
 dsn = os.getenv("DATABASE_URL")
 
+# Postgres NOTIFY channel workers LISTEN on for new / advanced jobs
+JOBS_CHANNEL = os.getenv("JOBS_CHANNEL", "jobs")
+# song UPDATE/DELETE notifications for cache invalidation; must match the
+# songs_notify_change trigger argument in db/init.sql
+SONGS_CHANNEL = os.getenv("SONGS_CHANNEL", "songs")
+
+# pipeline stages, in the order a job runs them
+STAGES = ("identify", "demucs", "whisper", "classify")
+RUNNABLE_STATUSES = ("Not Started", "Queued", "In Progress")
+
+# inlined (not bound) so the planner can match idx_jobs_runnable's partial predicate
+RUNNABLE_STATUSES_SQL = ", ".join(f"'{s}'" for s in RUNNABLE_STATUSES)
+
+# jobs in these states are done for good and get moved to jobs_archive
+TERMINAL_STATUSES = ("Completed", "Complete", "Failed", "Dead")
+TERMINAL_STATUSES_SQL = ", ".join(f"'{s}'" for s in TERMINAL_STATUSES)
+
 
 @asynccontextmanager
 async def lifespan(app):
@@ -41,6 +62,7 @@ async def create_job(
     duration: Optional[int] = None,
     fingerprint: Optional[str] = None,
     fingerprint_hash: Optional[str] = None,
+    content_hash: Optional[str] = None,
     audio_processed: bool = False,
     want_identify: bool = False,
     want_demucs: bool = False,
@@ -52,22 +74,33 @@ async def create_job(
     done_classify: bool = False,
 ) -> int:
     sql = """
+    WITH ins AS (
     INSERT INTO jobs (
       song_id, current_stage, status, input_type,
       title, artist, lyrics, classification, accuracy,
       file_path, duration, fingerprint, fingerprint_hash,
       audio_processed,
       want_identify, want_demucs, want_whisper, want_classify,
-      done_identify, done_demucs, done_whisper, done_classify
+      done_identify, done_demucs, done_whisper, done_classify,
+      content_hash
     ) VALUES (
       $1,$2,$3,$4,
       $5,$6,$7,$8,$9,
       $10,$11,$12,$13,
       $14,
       $15,$16,$17,$18,
-      $19,$20,$21,$22
+      $19,$20,$21,$22,
+      $24
     )
-    RETURNING id;
+    RETURNING id, status, current_stage, next_stage
+    )
+    -- wake LISTENing workers in the same round trip
+    SELECT ins.id,
+           pg_notify($23, json_build_object(
+             'id', ins.id, 'status', ins.status, 'current_stage', ins.current_stage,
+             'next_stage', ins.next_stage
+           )::text)
+    FROM ins;
     """
     return await conn.fetchval(
         sql,
@@ -93,16 +126,309 @@ async def create_job(
         done_demucs,
         done_whisper,
         done_classify,
+        JOBS_CHANNEL,
+        content_hash,
+    )
+
+
+# ---- prepared statements ----
+# Every stage outcome has one fixed statement, prepared under its own name on each pool
+# connection (see init_connection), so the hot path never builds or re-parses SQL.
+# The names show up in pg_prepared_statements and in /metrics/statements.
+_CHANNEL_SQL = "'" + JOBS_CHANNEL.replace("'", "''") + "'"
+
+# clears the lease/retry bookkeeping when a stage finishes
+_RELEASE_SQL = "'claimed_at', NULL, 'lease_expires_at', NULL, 'attempts', 0, 'next_attempt_at', NULL"
+
+
+def _fenced(claimed_at_param: int) -> str:
+    # Every write-back is fenced on the claim it was computed under: if the reaper
+    # requeued the job (and maybe another worker claimed it) while we worked, no row
+    # comes back and nothing is written. FOR UPDATE rechecks after any concurrent write;
+    # MATERIALIZED keeps the lock ahead of complete_stage() in the SELECT list.
+    return f"""
+        WITH lease AS MATERIALIZED (
+          SELECT id FROM jobs
+          WHERE id = $1 AND status = 'Claimed' AND claimed_at = ${claimed_at_param}::timestamptz
+          FOR UPDATE
+        )"""
+
+
+# Each statement's last parameter is the claimed_at the worker got from claim_jobs.
+STAGE_STATEMENTS = {
+    # (job_id, title, artist, duration, fingerprint, fingerprint_hash, file_path,
+    #  lyrics, classification, accuracy, done_demucs, done_whisper, done_classify, current_stage,
+    #  leader_job_id, fp_subfingerprints, claimed_at) -- with a leader the job parks as 'Waiting'
+    #  instead of queueing its next stage
+    "job_identify_done": f"""{_fenced(17)}
+        SELECT complete_stage(lease.id, jsonb_build_object(
+          'title', $2::text, 'artist', $3::text, 'duration', $4::int,
+          'fingerprint', $5::text, 'fingerprint_hash', $6::text, 'file_path', $7::text,
+          'lyrics', $8::text, 'classification', $9::text, 'accuracy', $10::numeric,
+          'done_identify', true, 'done_demucs', $11::bool,
+          'done_whisper', $12::bool, 'done_classify', $13::bool,
+          'status', CASE WHEN $15::bigint IS NULL THEN 'Not Started' ELSE 'Waiting' END,
+          'current_stage', $14::text, 'leader_job_id', $15::bigint,
+          'fp_subfingerprints', $16::bytea,
+          {_RELEASE_SQL}
+        ), {_CHANNEL_SQL}) FROM lease
+    """,
+    # (job_id, song_id, claimed_at) -- identify found the song already fully processed
+    "job_identify_known_song": f"""{_fenced(3)}
+        SELECT complete_stage(lease.id, jsonb_build_object(
+          'status', 'Completed', 'song_id', $2::int,
+          'claimed_at', NULL, 'lease_expires_at', NULL
+        ), {_CHANNEL_SQL}) FROM lease
+    """,
+    # (job_id, claimed_at) -- no fingerprint, nothing downstream can work
+    "job_identify_failed": f"""
+        WITH upd AS (
+          UPDATE jobs
+          SET status = 'Failed', claimed_at = NULL, lease_expires_at = NULL
+          WHERE id = $1 AND status = 'Claimed' AND claimed_at = $2::timestamptz
+          RETURNING id, status, current_stage, next_stage, song_id
+        )
+        SELECT pg_notify({_CHANNEL_SQL}, row_to_json(upd)::text) FROM upd
+    """,
+    # (job_id, file_path, claimed_at)
+    "job_demucs_done": f"""{_fenced(3)}
+        SELECT complete_stage(lease.id, jsonb_build_object(
+          'file_path', $2::text, 'done_demucs', true,
+          'status', 'Not Started', 'current_stage', 'whisper',
+          {_RELEASE_SQL}
+        ), {_CHANNEL_SQL}) FROM lease
+    """,
+    # (job_id, lyrics, claimed_at)
+    "job_whisper_done": f"""{_fenced(3)}
+        SELECT complete_stage(lease.id, jsonb_build_object(
+          'lyrics', $2::text, 'done_whisper', true,
+          'status', 'Not Started', 'current_stage', 'classify',
+          {_RELEASE_SQL}
+        ), {_CHANNEL_SQL}) FROM lease
+    """,
+    # (job_id, classification, accuracy, claimed_at)
+    "job_classify_done": f"""{_fenced(4)}
+        SELECT complete_stage(lease.id, jsonb_build_object(
+          'classification', $2::text, 'accuracy', $3::numeric, 'done_classify', true,
+          'status', 'Not Started', 'current_stage', 'None',
+          {_RELEASE_SQL}
+        ), {_CHANNEL_SQL}) FROM lease
+    """,
+    # (job_id, attempts, error, retry_in_secs or NULL to dead-letter, claimed_at)
+    "job_stage_failed": f"""
+        WITH upd AS (
+          UPDATE jobs
+          SET status = CASE WHEN $4::float8 IS NULL THEN 'Dead' ELSE 'Queued' END,
+              attempts = $2,
+              last_error = $3,
+              next_attempt_at = CASE
+                WHEN $4::float8 IS NULL THEN NULL
+                ELSE now() + make_interval(secs => $4::float8)
+              END,
+              claimed_at = NULL,
+              lease_expires_at = NULL
+          WHERE id = $1 AND status = 'Claimed' AND claimed_at = $5::timestamptz
+          RETURNING id, status, current_stage, next_stage, song_id, attempts
+        )
+        -- progress streams see retries and dead-letters; workers ignore it until next_attempt_at.
+        -- a dead leader hands its single-flight followers back to the queue
+        SELECT pg_notify({_CHANNEL_SQL}, row_to_json(upd)::text),
+               CASE WHEN upd.status = 'Dead' THEN release_followers(upd.id, {_CHANNEL_SQL}) END
+        FROM upd
+    """,
+    # (job_id, claimed_at) -- the worker is shutting down mid-stage: hand the job back
+    # as it was claimed, without spending an attempt
+    "job_release_claim": f"""
+        WITH upd AS (
+          UPDATE jobs
+          SET status = 'Queued', claimed_at = NULL, lease_expires_at = NULL
+          WHERE id = $1 AND status = 'Claimed' AND claimed_at = $2::timestamptz
+          RETURNING id, status, current_stage, next_stage, song_id
+        )
+        SELECT pg_notify({_CHANNEL_SQL}, row_to_json(upd)::text) FROM upd
+    """,
+    # (job_id, claimed_at, lease_secs)
+    "job_heartbeat": """
+        UPDATE jobs
+        SET lease_expires_at = now() + make_interval(secs => $3)
+        WHERE id = $1 AND status = 'Claimed' AND claimed_at = $2
+        RETURNING id
+    """,
+}
+
+# name -> {"calls": n, "total_ms": t}, filled in by run_statement
+STATEMENT_STATS: Dict[str, Dict[str, float]] = {
+    name: {"calls": 0, "total_ms": 0.0} for name in STAGE_STATEMENTS
+}
+
+
+class JobsConnection(asyncpg.Connection):
+    """asyncpg connection that carries the named STAGE_STATEMENTS prepared on it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = {}
+
+
+async def init_connection(conn) -> None:
+    """Pool `init` hook: prepare every stage statement once per new connection."""
+    for name, sql in STAGE_STATEMENTS.items():
+        conn.statements[name] = await conn.prepare(sql, name=name)
+
+
+async def run_statement(conn, name: str, *args):
+    """Run a named stage statement and return its first row (or None)."""
+    stmt = getattr(conn, "statements", {}).get(name)
+    start = time.perf_counter()
+    if stmt is not None:
+        row = await stmt.fetchrow(*args)
+    else:
+        # connection from a pool without init_connection: same SQL, just not pre-named
+        row = await conn.fetchrow(STAGE_STATEMENTS[name], *args)
+    stats = STATEMENT_STATS[name]
+    stats["calls"] += 1
+    stats["total_ms"] += (time.perf_counter() - start) * 1000
+    return row
+
+
+class LeaseLost(RuntimeError):
+    """The claim a stage ran under was reaped (and maybe re-claimed) before its write-back."""
+
+
+async def run_stage_statement(conn, name: str, *args) -> Optional[int]:
+    """
+    Run one of the fenced stage statements; returns the song id if the job completed.
+    Raises LeaseLost if the job is no longer ours, in which case nothing was written.
+    """
+    row = await run_statement(conn, name, *args)
+    if row is None:
+        raise LeaseLost(f"job {args[0]}: lease lost before {name}")
+    return row[0]
+
+
+async def statement_metrics(conn) -> Dict[str, Any]:
+    """Per-statement call counts/latency, plus what the server has prepared on `conn`."""
+    rows = await conn.fetch(
+        """
+        SELECT name, prepare_time, generic_plans, custom_plans
+        FROM pg_prepared_statements
+        WHERE name = ANY($1::text[])
+        """,
+        list(STAGE_STATEMENTS),
+    )
+    prepared = {r["name"]: dict(r) for r in rows}
+    out = {}
+    for name, stats in STATEMENT_STATS.items():
+        calls = int(stats["calls"])
+        out[name] = {
+            "calls": calls,
+            "total_ms": round(stats["total_ms"], 3),
+            "mean_ms": round(stats["total_ms"] / calls, 3) if calls else None,
+            "prepared": prepared.get(name),
+        }
+    return out
+
+
+# ---- leases ----
+async def heartbeat_job(conn, job_id: int, claimed_at, lease_secs: float) -> bool:
+    """
+    Push the lease of a claimed job forward. Returns False if we no longer own it
+    (the reaper requeued it and someone else claimed it).
+    """
+    row = await run_statement(conn, "job_heartbeat", job_id, claimed_at, lease_secs)
+    return row is not None
+
+
+async def release_claim(conn, job_id: int, claimed_at) -> bool:
+    """
+    Give a claimed job back to the queue untouched (attempts included), for a worker
+    that is stopping mid-stage. Returns False if the claim was no longer ours.
+    """
+    row = await run_statement(conn, "job_release_claim", job_id, claimed_at)
+    return row is not None
+
+
+async def requeue_expired_leases(conn, max_attempts: int) -> list[int]:
+    """
+    Put 'Claimed' jobs whose lease ran out (crashed / redeployed worker) back in the queue
+    and NOTIFY so a worker picks them up right away. A lost lease counts as an attempt,
+    so a stage that keeps killing its worker ends up dead-lettered. Returns the requeued job ids.
+    """
+    sql = """
+    WITH reaped AS (
+      UPDATE jobs
+      SET status = CASE WHEN attempts + 1 >= $2 THEN 'Dead' ELSE 'Queued' END,
+          attempts = attempts + 1,
+          last_error = 'lease expired',
+          claimed_at = NULL,
+          lease_expires_at = NULL
+      WHERE status = 'Claimed'
+        AND (lease_expires_at IS NULL OR lease_expires_at < now())
+      RETURNING id, status, current_stage, next_stage
     )
+    SELECT id, pg_notify($1, json_build_object(
+      'id', id, 'status', status, 'current_stage', current_stage, 'next_stage', next_stage
+    )::text),
+    CASE WHEN status = 'Dead' THEN release_followers(id, $1) END
+    FROM reaped
+    """
+    rows = await conn.fetch(sql, JOBS_CHANNEL, max_attempts)
+    return [r["id"] for r in rows]
 
 
-async def update_job(conn, job_id: int, **fields):
-    if not fields:
-        return
-    cols = ", ".join(f"{k} = ${i}" for i, k in enumerate(fields.keys(), start=1))
-    values = list(fields.values()) + [job_id]
-    sql = f"UPDATE jobs SET {cols} WHERE id = ${len(values)}"
-    await conn.execute(sql, *values)
+async def release_orphaned_followers(conn) -> list[int]:
+    """
+    Backstop for single-flight: requeue 'Waiting' jobs whose leader is gone (archived) or
+    finished without handing them its results, so they run their own remaining stages.
+    Returns the released job ids.
+    """
+    sql = f"""
+    WITH released AS (
+      UPDATE jobs w
+      SET status = 'Queued', leader_job_id = NULL
+      WHERE w.status = 'Waiting'
+        AND NOT EXISTS (
+          SELECT 1 FROM jobs l
+          WHERE l.id = w.leader_job_id AND l.status NOT IN ({TERMINAL_STATUSES_SQL})
+        )
+      RETURNING w.id, w.status, w.current_stage, w.next_stage, w.song_id
+    )
+    SELECT id, pg_notify($1, row_to_json(released)::text) FROM released
+    """
+    rows = await conn.fetch(sql, JOBS_CHANNEL)
+    return [r["id"] for r in rows]
+
+
+async def queue_depths(conn) -> Dict[str, int]:
+    """Runnable (unclaimed) jobs per next stage; served from idx_jobs_runnable."""
+    rows = await conn.fetch(
+        f"""
+        SELECT next_stage, count(*) AS n
+        FROM jobs
+        WHERE status IN ({RUNNABLE_STATUSES_SQL}) AND next_stage IS NOT NULL
+        GROUP BY next_stage
+        """
+    )
+    return {r["next_stage"]: r["n"] for r in rows}
+
+
+# ---- retries ----
+async def record_stage_failure(
+    conn,
+    job_id: int,
+    *,
+    attempts: int,
+    error: str,
+    retry_in: Optional[float],
+    claimed_at,
+) -> None:
+    """
+    Release a failed claim. With `retry_in` (seconds) the job goes back to 'Queued'
+    and can't be claimed until then; with None it is dead-lettered as 'Dead'.
+    Done flags are untouched, so finished stages are never rerun.
+    Raises LeaseLost (and changes nothing) if the claim is no longer ours.
+    """
+    await run_stage_statement(conn, "job_stage_failed", job_id, attempts, error, retry_in, claimed_at)
 
 
 # ---- UPSERT by fingerprint_hash (idempotent write) ----
@@ -203,114 +529,193 @@ async def upsert_job_by_fingerprint(
     )
 
 
-# ---- UPDATE by id (partial/dynamic) ----
-async def update_job_fields(
-    conn: asyncpg.Connection,
-    job_id: int,
-    fields: Dict[str, Any],
+async def get_song_by_fingerprint_hash(conn, fingerprint_hash: str) -> dict | None:
+    
+        row = await conn.fetchrow(
+            "SELECT * FROM songs WHERE fingerprint_hash = $1", fingerprint_hash
+        )
+        return row if row else None
+
+
+# ---- song listing (keyset pagination) ----
+# what /api/songs returns by default: cheap columns plus a short lyrics preview
+SONG_SUMMARY_COLUMNS = (
+    "id", "title", "artist", "classification", "accuracy", "duration", "created_at",
+)
+SONG_SUMMARY_SQL = ", ".join(SONG_SUMMARY_COLUMNS) + ", LEFT(lyrics, 160) AS lyrics_preview"
+
+# big or rarely needed columns, only returned when asked for with fields=
+SONG_HEAVY_COLUMNS = (
+    "lyrics", "fingerprint", "fingerprint_hash", "file_path", "audio_processed", "updated_at",
+)
+
+# everything a client may see for one song (fp_subfingerprints is binary and internal)
+SONG_DETAIL_SQL = ", ".join(
+    SONG_SUMMARY_COLUMNS + SONG_HEAVY_COLUMNS + ("content_hash",)
+)
+
+
+async def get_song_by_id(conn, song_id: int):
+    return await conn.fetchrow(f"SELECT {SONG_DETAIL_SQL} FROM songs WHERE id = $1", song_id)
+
+
+# ---- cached song lookups ----
+# hits never check out a connection; misses fill SONG_CACHE unless the song was
+# invalidated while the query ran (see LRUCache.generation)
+async def get_song_cached(pool, song_id: int):
+    row = SONG_CACHE.get_by_id(song_id)
+    if row is None:
+        gen = SONG_CACHE.generation
+        async with pool.acquire() as conn:
+            row = await get_song_by_id(conn, song_id)
+        if row is not None:
+            SONG_CACHE.put_by_id(song_id, row, gen)
+    return row
+
+
+async def get_song_by_fingerprint_hash_cached(pool, fingerprint_hash: str):
+    row = SONG_CACHE.get_by_fingerprint(fingerprint_hash)
+    if row is None:
+        gen = SONG_CACHE.generation
+        async with pool.acquire() as conn:
+            row = await get_song_by_fingerprint_hash(conn, fingerprint_hash)
+        if row is not None:
+            SONG_CACHE.put_by_fingerprint(fingerprint_hash, row, gen)
+    return row
+
+
+async def list_songs_page(
+    conn,
     *,
-    allowed: Iterable[str] = (
-        "song_id",
-        "current_stage",
-        "status",
-        "input_type",
-        "title",
-        "artist",
-        "lyrics",
-        "classification",
-        "accuracy",
-        "file_path",
-        "duration",
-        "fingerprint",
-        "fingerprint_hash",
-        "audio_processed",
-        "want_identify",
-        "want_demucs",
-        "want_whisper",
-        "want_classify",
-        "done_identify",
-        "done_demucs",
-        "done_whisper",
-        "done_classify",
-    ),
-) -> None:
+    limit: int,
+    after: Optional[tuple] = None,
+    fields: Iterable[str] = (),
+) -> list[dict]:
     """
-    Dynamically updates only the provided columns.
-    Example: await update_job_fields(conn, 42, {"status":"processing","current_stage":"whisper"})
+    One page of songs, newest first, ordered by (created_at, id) and served from
+    idx_songs_created_id. `after` is the (created_at, id) of the last row of the
+    previous page. `fields` adds columns from SONG_HEAVY_COLUMNS.
     """
-    if not fields:
-        return
-    sets = []
-    values = []
-    idx = 1
-    for k, v in fields.items():
-        if k not in allowed:
-            raise ValueError(f"Column not allowed: {k}")
-        sets.append(f"{k} = ${idx}")
-        values.append(v)
-        idx += 1
-    values.append(job_id)
-    sql = f"UPDATE jobs SET {', '.join(sets)} WHERE id = ${idx};"
-    await conn.execute(sql, *values)
-
-
-async def upsert_song(
-    conn: asyncpg.Connection,
+    extra = [f for f in SONG_HEAVY_COLUMNS if f in set(fields)]
+    cols = ", ".join([SONG_SUMMARY_SQL, *extra])
+    if after is None:
+        rows = await conn.fetch(
+            f"SELECT {cols} FROM songs ORDER BY created_at DESC, id DESC LIMIT $1",
+            limit,
+        )
+    else:
+        rows = await conn.fetch(
+            f"""
+            SELECT {cols} FROM songs
+            WHERE (created_at, id) < ($2::timestamp, $3::int)
+            ORDER BY created_at DESC, id DESC
+            LIMIT $1
+            """,
+            limit,
+            after[0],
+            after[1],
+        )
+    return [dict(r) for r in rows]
+
+
+# ---- upload dedupe by content hash ----
+async def find_song_by_content_hash(
+    conn,
+    content_hash: str,
     *,
-    title: str,
-    artist: Optional[str],
-    duration: Optional[float],
-    fingerprint: Optional[str],
-    fingerprint_hash: str,
-    lyrics: Optional[str],
-    classification: Optional[str],
-    accuracy: Optional[float],
-    file_path: str,
-    audio_processed: bool,
-) -> int:
-    # normalize
-    dur = int(duration) if isinstance(duration, float) else duration
+    want_demucs: bool,
+    want_whisper: bool,
+    want_classify: bool,
+) -> Optional[int]:
+    """Id of a song built from these exact bytes that already has every requested output."""
+    return await conn.fetchval(
+        """
+        SELECT id FROM songs
+        WHERE content_hash = $1
+          AND (NOT $2 OR file_path LIKE '/shared_data/stems/%')
+          AND (NOT $3 OR lyrics IS NOT NULL)
+          AND (NOT $4 OR classification IS NOT NULL)
+        LIMIT 1
+        """,
+        content_hash,
+        want_demucs,
+        want_whisper,
+        want_classify,
+    )
+
 
-    row = await conn.fetchrow(
+async def find_live_job_by_content_hash(
+    conn,
+    content_hash: str,
+    *,
+    want_identify: bool,
+    want_demucs: bool,
+    want_whisper: bool,
+    want_classify: bool,
+) -> Optional[int]:
+    """Id of a still-running job for these exact bytes that will produce every requested output."""
+    return await conn.fetchval(
         """
-        INSERT INTO songs (
-            title, artist, duration, fingerprint, fingerprint_hash,
-            lyrics, classification, accuracy, file_path, audio_processed
-        )
-        VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)
-        ON CONFLICT (fingerprint_hash) DO UPDATE SET
-            title          = COALESCE(EXCLUDED.title, songs.title),
-            artist         = COALESCE(EXCLUDED.artist, songs.artist),
-            duration       = COALESCE(EXCLUDED.duration, songs.duration),
-            fingerprint    = COALESCE(EXCLUDED.fingerprint, songs.fingerprint),
-            lyrics         = COALESCE(EXCLUDED.lyrics, songs.lyrics),
-            classification = COALESCE(EXCLUDED.classification, songs.classification),
-            accuracy       = COALESCE(EXCLUDED.accuracy, songs.accuracy),
-            file_path      = COALESCE(EXCLUDED.file_path, songs.file_path),
-            -- keep True if either side is True
-            audio_processed = (EXCLUDED.audio_processed OR songs.audio_processed)
-        RETURNING id;
+        SELECT id FROM jobs
+        WHERE content_hash = $1
+          AND status IN ('Not Started','Queued','In Progress','Claimed','Waiting')
+          AND (NOT $2 OR want_identify)
+          AND (NOT $3 OR want_demucs)
+          AND (NOT $4 OR want_whisper)
+          AND (NOT $5 OR want_classify)
+        ORDER BY id
+        LIMIT 1
         """,
-        title,
-        artist,
-        dur,
-        fingerprint,
-        fingerprint_hash,
-        lyrics,
-        classification,
-        accuracy,
-        file_path,
-        audio_processed,
+        content_hash,
+        want_identify,
+        want_demucs,
+        want_whisper,
+        want_classify,
     )
-    return row["id"]
 
 
-async def get_song_by_fingerprint_hash(conn, fingerprint_hash: str) -> dict | None:
-    
-        row = await conn.fetchrow(
-            "SELECT * FROM songs WHERE fingerprint_hash = $1", fingerprint_hash
-        )
-        return row if row else None
+# ---- single-flight by fingerprint ----
+async def lock_fingerprint_leader(
+    conn,
+    job_id: int,
+    fingerprint_hash: str,
+    *,
+    want_demucs: bool,
+    want_whisper: bool,
+    want_classify: bool,
+) -> Optional[int]:
+    """
+    Id of a live job for the same fingerprint that will produce every stage this job
+    still needs, or None if this job should run them itself (and so lead any later twins).
+
+    Must run inside the transaction that writes this job's identify result: the advisory
+    lock is held until commit, so two jobs identifying the same track at once are
+    serialized and the second one sees the first's fingerprint_hash. The leader's row is
+    held FOR SHARE until then too, so it can't complete (or die) between being picked
+    and this job parking as 'Waiting' -- complete_stage() / release_followers() wait for
+    the commit and then see the follower.
+    """
+    await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", fingerprint_hash)
+    return await conn.fetchval(
+        """
+        SELECT id FROM jobs
+        WHERE fingerprint_hash = $1
+          AND id <> $2
+          AND leader_job_id IS NULL
+          AND status IN ('Not Started','Queued','In Progress','Claimed')
+          AND (NOT $3 OR want_demucs)
+          AND (NOT $4 OR want_whisper)
+          AND (NOT $5 OR want_classify)
+        ORDER BY id
+        LIMIT 1
+        FOR SHARE
+        """,
+        fingerprint_hash,
+        job_id,
+        want_demucs,
+        want_whisper,
+        want_classify,
+    )
 
 
 # helper
@@ -330,28 +735,186 @@ async def get_song_by_title_artist(pool, title, artist) -> int | None:
         return row["id"] if row else None
 
 
-async def search_song_fuzzy(pool, title: str, artist: str, limit: int = 5):
-    sql = """
-    SELECT id, title, artist,
-       similarity(LOWER(title),  LOWER($1)) +
-       similarity(LOWER(artist), LOWER($2)) AS score
-FROM songs
-ORDER BY (LOWER(title) <-> LOWER($1)) +
-         (LOWER(artist) <-> LOWER($2))
-LIMIT $3;
+# per-field trigram similarity a song needs to be a search candidate. Callers accept a
+# combined title+artist score >= 0.3, so one of the two is always >= 0.15
+FUZZY_MIN_SIMILARITY = float(os.getenv("FUZZY_MIN_SIMILARITY", "0.15"))
+# nearest neighbours pulled per field before rescoring on title+artist
+FUZZY_CANDIDATES = int(os.getenv("FUZZY_CANDIDATES", "50"))
 
-    """
+# each branch is a `%` filter + `<->` KNN scan on its own GiST index; only the
+# union of candidates is rescored, so cost no longer grows with the songs table
+SEARCH_SONG_FUZZY_SQL = """
+WITH cand AS (
+  (SELECT id FROM songs
+   WHERE title_norm % lower($1)
+   ORDER BY title_norm <-> lower($1)
+   LIMIT $4)
+  UNION
+  (SELECT id FROM songs
+   WHERE artist_norm % lower($2)
+   ORDER BY artist_norm <-> lower($2)
+   LIMIT $4)
+)
+SELECT s.id, s.title, s.artist,
+       similarity(s.title_norm, lower($1)) +
+       similarity(s.artist_norm, lower($2)) AS score
+FROM cand
+JOIN songs s USING (id)
+ORDER BY score DESC, s.id
+LIMIT $3
+"""
+
+
+async def fetch_song_fuzzy(conn, title: str, artist: str, limit: int = 5):
+    # the `%` threshold is a GUC; set it transaction-local, since a session-level SET
+    # is undone by the RESET ALL asyncpg runs whenever a connection goes back to the pool
+    async with conn.transaction():
+        await conn.execute(
+            "SELECT set_config('pg_trgm.similarity_threshold', $1, true)",
+            f"{FUZZY_MIN_SIMILARITY:f}",
+        )
+        return await conn.fetch(
+            SEARCH_SONG_FUZZY_SQL, title, artist, limit, max(limit, FUZZY_CANDIDATES)
+        )
+
+
+async def search_song_fuzzy(pool, title: str, artist: str, limit: int = 5):
     async with pool.acquire() as conn:
-        rows = await conn.fetch(sql, title, artist, limit)
+        rows = await fetch_song_fuzzy(conn, title, artist, limit)
     return [dict(r) for r in rows]
 
 
 
+# columns progress streams care about (no lyrics / fingerprint)
+JOB_STATUS_SQL = "id, status, current_stage, next_stage, song_id"
+
+
+async def get_job_status(conn, job_id: int) -> Optional[Dict[str, Any]]:
+    """Small status projection of a job, live table first, then the archive."""
+    row = await conn.fetchrow(f"SELECT {JOB_STATUS_SQL} FROM jobs WHERE id = $1", job_id)
+    if not row:
+        row = await conn.fetchrow(
+            f"SELECT {JOB_STATUS_SQL} FROM jobs_archive WHERE id = $1 ORDER BY archived_at DESC LIMIT 1",
+            job_id,
+        )
+    return dict(row) if row else None
+
+
 async def get_job(pool, job_id: int) -> Optional[Dict[str, Any]]:
+    """Look a job up in the live table first, then in the archive."""
     async with pool.acquire() as conn:
         row = await conn.fetchrow("SELECT * FROM jobs WHERE id = $1", job_id)
-        return dict(row) if row else None
+        if not row:
+            row = await conn.fetchrow(
+                "SELECT * FROM jobs_archive WHERE id = $1 ORDER BY archived_at DESC LIMIT 1",
+                job_id,
+            )
+    if not row:
+        return None
+    job = dict(row)
+    job.pop("fp_subfingerprints", None)  # binary, internal to identify
+    return job
+
+
+# ---- singleton background tasks across replicas ----
+@asynccontextmanager
+async def singleton_lock(conn, name: str):
+    """
+    Yields True if this session got the cluster-wide advisory lock for `name`
+    (e.g. "reaper"), False if another replica holds it -- skip the pass then.
+    Session-level so it can span several statements; unlocked on exit (and the
+    pool's reset query unlocks everything on release anyway).
+    """
+    got = await conn.fetchval(
+        "SELECT pg_try_advisory_lock(hashtext('orchestrator'), hashtext($1))", name
+    )
+    try:
+        yield got
+    finally:
+        if got:
+            await conn.execute(
+                "SELECT pg_advisory_unlock(hashtext('orchestrator'), hashtext($1))", name
+            )
+
+
+# ---- archive ----
+def _add_months(d: date, months: int) -> date:
+    y, m = divmod(d.month - 1 + months, 12)
+    return date(d.year + y, m + 1, 1)
+
+
+async def ensure_archive_partitions(conn, months_ahead: int = 1) -> None:
+    """Create this month's (and the next `months_ahead`) jobs_archive partitions."""
+    this_month = date.today().replace(day=1)
+    for i in range(months_ahead + 1):
+        start = _add_months(this_month, i)
+        end = _add_months(start, 1)
+        # names/bounds come from dates, never user input
+        await conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS jobs_archive_{start:%Y_%m}
+            PARTITION OF jobs_archive
+            FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')
+            """
+        )
+
+
+async def archive_finished_jobs(conn, older_than_secs: float, batch_size: int = 1000) -> int:
+    """
+    Move terminal jobs that haven't changed for `older_than_secs` from jobs to jobs_archive,
+    `batch_size` rows per statement. Returns how many were moved.
+    """
+    sql = """
+    WITH moved AS (
+      DELETE FROM jobs
+      WHERE id IN (
+        SELECT id FROM jobs
+        WHERE status = ANY($1::text[])
+          AND updated_at < now() - make_interval(secs => $2)
+        LIMIT $3
+        FOR UPDATE SKIP LOCKED
+      )
+      RETURNING *
+    )
+    -- jobs_archive is LIKE jobs + archived_at, so the column order lines up
+    INSERT INTO jobs_archive SELECT moved.*, now() FROM moved
+    """
+    total = 0
+    while True:
+        status = await conn.execute(sql, list(TERMINAL_STATUSES), older_than_secs, batch_size)
+        moved = int(status.split()[-1])  # "INSERT 0 <n>"
+        total += moved
+        if moved < batch_size:
+            return total
+
+
+async def drop_expired_archive_partitions(conn, retention_days: int) -> list[str]:
+    """Drop monthly jobs_archive partitions that ended more than `retention_days` ago."""
+    rows = await conn.fetch(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'jobs_archive'
+        """
+    )
+    cutoff = date.fromordinal(date.today().toordinal() - retention_days)
+    dropped = []
+    for r in rows:
+        m = re.fullmatch(r"jobs_archive_(\d{4})_(\d{2})", r["relname"])
+        if not m:
+            continue
+        end = _add_months(date(int(m.group(1)), int(m.group(2)), 1), 1)
+        if end <= cutoff:
+            await conn.execute(f"DROP TABLE IF EXISTS {r['relname']}")
+            dropped.append(r["relname"])
+    return dropped
 
 
 async def setup_db_pool(dsn: str):
-    return await asyncpg.create_pool(dsn)
+    return await asyncpg.create_pool(
+        dsn,
+        connection_class=JobsConnection,
+        init=init_connection,
+    )
@@ -0,0 +1,45 @@
+import asyncio
+import logging
+from typing import Dict, Set
+
+logger = logging.getLogger("orchestrator")
+
+
+class JobEventBroker:
+    """
+    In-process fan-out of job NOTIFY payloads to streaming clients.
+    Each subscriber gets its own bounded queue per job id; the single LISTEN
+    connection publishes into it, so N browser tabs cost N queues, not N DB queries.
+    """
+
+    def __init__(self, max_queue: int = 100):
+        self._max_queue = max_queue
+        self._subs: Dict[int, Set[asyncio.Queue]] = {}
+
+    def subscribe(self, job_id: int) -> asyncio.Queue:
+        q: asyncio.Queue = asyncio.Queue(maxsize=self._max_queue)
+        self._subs.setdefault(job_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, job_id: int, q: asyncio.Queue) -> None:
+        subs = self._subs.get(job_id)
+        if not subs:
+            return
+        subs.discard(q)
+        if not subs:
+            del self._subs[job_id]
+
+    def publish(self, event: dict) -> None:
+        job_id = event.get("id")
+        for q in self._subs.get(job_id, ()):
+            if q.full():
+                # slow consumer: drop its oldest event, the newest state matters most
+                try:
+                    q.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            q.put_nowait(event)
+
+    @property
+    def subscriber_count(self) -> int:
+        return sum(len(s) for s in self._subs.values())
@@ -0,0 +1,294 @@
+import asyncio
+import base64
+import logging
+import os
+import struct
+import time
+from array import array
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("orchestrator")
+
+# near-duplicate matching: a song counts as the same recording when the best
+# alignment has at most this bit error rate over at least this much overlap
+NEAR_DUP_MAX_BER = float(os.getenv("NEAR_DUP_MAX_BER", "0.15"))
+NEAR_DUP_MIN_OVERLAP = float(os.getenv("NEAR_DUP_MIN_OVERLAP", "0.5"))  # fraction of the shorter print
+NEAR_DUP_MIN_VOTES = int(os.getenv("NEAR_DUP_MIN_VOTES", "3"))
+NEAR_DUP_CANDIDATES = int(os.getenv("NEAR_DUP_CANDIDATES", "5"))
+FP_INDEX_REFRESH_SECS = float(os.getenv("FP_INDEX_REFRESH_SECS", "2"))
+# songs read (and decoded, off the event loop) per round trip while catching up
+FP_INDEX_BATCH = int(os.getenv("FP_INDEX_BATCH", "200"))
+# the index holds every print in RAM: ~7.5 KB for a 4-minute song plus about half that
+# again in postings. Past this many songs new ones aren't indexed (0 = no cap)
+FP_INDEX_MAX_SONGS = int(os.getenv("FP_INDEX_MAX_SONGS", "0"))
+
+# inverted index keys are the top bits of a subfingerprint; only keys with
+# key % FP_INDEX_SAMPLE == 0 are indexed. The sampling depends on the value,
+# not the position, so a trimmed or shifted copy samples the same frames.
+FP_INDEX_KEY_SHIFT = int(os.getenv("FP_INDEX_KEY_SHIFT", "12"))
+FP_INDEX_SAMPLE = int(os.getenv("FP_INDEX_SAMPLE", "4"))
+
+_POS_BITS = 20  # postings pack (song_id << 20 | position) into one uint64
+_POS_MASK = (1 << _POS_BITS) - 1
+
+
+# ---- Chromaprint compressed fingerprint <-> subfingerprints ----
+def _unpack_ints(data: bytes, width: int, count: int) -> List[int]:
+    # Chromaprint packs small ints LSB-first across the byte stream; a value
+    # never spans more than two bytes for width <= 8
+    padded = data + b"\x00"
+    mask = (1 << width) - 1
+    out = []
+    for i in range(count):
+        bit = width * i
+        byte = bit >> 3
+        out.append(((padded[byte] | (padded[byte + 1] << 8)) >> (bit & 7)) & mask)
+    return out
+
+
+def decode_fingerprint(fingerprint: str) -> List[int]:
+    """
+    Decode fpcalc's compressed, base64 FINGERPRINT= string into its 32-bit
+    subfingerprints (same algorithm as chromaprint_decode_fingerprint).
+    Raises ValueError on malformed input.
+    """
+    try:
+        data = base64.urlsafe_b64decode(fingerprint + "=" * (-len(fingerprint) % 4))
+    except Exception as e:
+        raise ValueError(f"fingerprint is not base64: {e}") from e
+    if len(data) < 4:
+        raise ValueError("fingerprint too short")
+    num_values = int.from_bytes(data[1:4], "big")
+    if num_values == 0:
+        return []
+
+    # 3-bit "normal" values: each is the gap to the next set bit, 0 ends a subfingerprint,
+    # 7 means the gap continues in the 5-bit exceptional stream
+    body = data[4:]
+    bits = _unpack_ints(body, 3, len(body) * 8 // 3)
+    found = exceptional = 0
+    for i, b in enumerate(bits):
+        if b == 0:
+            found += 1
+            if found == num_values:
+                del bits[i + 1:]
+                break
+        elif b == 7:
+            exceptional += 1
+    else:
+        raise ValueError("fingerprint truncated")
+
+    if exceptional:
+        offset = (len(bits) * 3 + 7) // 8
+        if len(body[offset:]) * 8 < exceptional * 5:
+            raise ValueError("fingerprint truncated")
+        extra = _unpack_ints(body[offset:], 5, exceptional)
+        it = iter(extra)
+        bits = [b + next(it) if b == 7 else b for b in bits]
+
+    out: List[int] = []
+    value = last_bit = 0
+    for b in bits:
+        if b == 0:
+            # subfingerprints are stored XOR-delta against the previous one
+            out.append(value ^ out[-1] if out else value)
+            value = last_bit = 0
+            continue
+        last_bit += b
+        value |= 1 << (last_bit - 1)
+    return out
+
+
+def pack_subfingerprints(values: List[int]) -> bytes:
+    """Compact storage form: little-endian uint32 array (4 bytes per ~124ms frame)."""
+    return struct.pack(f"<{len(values)}I", *values)
+
+
+def unpack_subfingerprints(blob: bytes) -> Tuple[int, ...]:
+    return struct.unpack(f"<{len(blob) // 4}I", blob)
+
+
+def bit_error_rate(a: bytes, b: bytes, offset: int) -> Tuple[float, int]:
+    """
+    BER of packed prints `a` and `b` with a[i] aligned to b[i + offset].
+    Returns (ber, overlap_frames). The whole overlap is XORed as one big int
+    and popcounted in C, so this stays fast without numpy.
+    """
+    if offset >= 0:
+        a_start, b_start = 0, offset
+    else:
+        a_start, b_start = -offset, 0
+    n = min(len(a) // 4 - a_start, len(b) // 4 - b_start)
+    if n <= 0:
+        return 1.0, 0
+    x = int.from_bytes(a[a_start * 4:(a_start + n) * 4], "little")
+    y = int.from_bytes(b[b_start * 4:(b_start + n) * 4], "little")
+    return (x ^ y).bit_count() / (32 * n), n
+
+
+class SubfingerprintIndex:
+    """
+    In-memory inverted index from sampled subfingerprint keys to (song, position)
+    postings, for finding near-duplicate recordings that miss the exact
+    fingerprint_hash match (other encodes, bitrates, trimmed intros).
+
+    Filled incrementally from songs.fp_subfingerprints by id, so every replica
+    catches up with songs promoted elsewhere on its next refresh. Memory grows with
+    the library (see FP_INDEX_MAX_SONGS).
+    """
+
+    def __init__(self):
+        self._postings: Dict[int, array] = {}
+        self._prints: Dict[int, bytes] = {}
+        self._max_id = 0
+        self._refreshed_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._prints)
+
+    @property
+    def full(self) -> bool:
+        return bool(FP_INDEX_MAX_SONGS) and len(self) >= FP_INDEX_MAX_SONGS
+
+    @staticmethod
+    def _keys(values) -> List[Tuple[int, int]]:
+        out = []
+        for pos, v in enumerate(values):
+            key = v >> FP_INDEX_KEY_SHIFT
+            if key % FP_INDEX_SAMPLE == 0:
+                out.append((pos, key))
+        return out
+
+    def add(self, song_id: int, packed: bytes) -> None:
+        if song_id in self._prints or not packed:
+            return
+        self._insert(song_id, packed, self._postings_for(song_id, packed))
+
+    def _insert(self, song_id: int, packed: bytes, postings: List[Tuple[int, int]]) -> None:
+        self._prints[song_id] = packed
+        for key, posting in postings:
+            self._postings.setdefault(key, array("Q")).append(posting)
+
+    @classmethod
+    def _postings_for(cls, song_id: int, packed: bytes) -> List[Tuple[int, int]]:
+        out = []
+        for pos, key in cls._keys(unpack_subfingerprints(packed)):
+            if pos > _POS_MASK:
+                break
+            out.append((key, (song_id << _POS_BITS) | pos))
+        return out
+
+    @classmethod
+    def _prepare(cls, rows) -> List[Tuple[int, bytes, List[Tuple[int, int]]]]:
+        # runs in a thread: legacy text prints take ~9 ms each to decode in Python
+        out = []
+        for r in rows:
+            packed = r["fp_subfingerprints"]
+            if packed is None:
+                # songs from before the column existed: decode the text print once
+                try:
+                    packed = pack_subfingerprints(decode_fingerprint(r["fingerprint"]))
+                except ValueError:
+                    continue
+            if packed:
+                out.append((r["id"], packed, cls._postings_for(r["id"], packed)))
+        return out
+
+    async def refresh(self, conn, force: bool = False) -> int:
+        """
+        Pull songs added since the last refresh, FP_INDEX_BATCH at a time, preparing each
+        batch in a thread so a cold start doesn't stall the event loop. Returns how many
+        were indexed.
+        """
+        if not force and time.monotonic() - self._refreshed_at < FP_INDEX_REFRESH_SECS:
+            return 0
+        async with self._lock:
+            if not force and time.monotonic() - self._refreshed_at < FP_INDEX_REFRESH_SECS:
+                return 0
+            added = 0
+            while not self.full:
+                rows = await conn.fetch(
+                    """
+                    SELECT id, fp_subfingerprints, fingerprint
+                    FROM songs
+                    WHERE id > $1 AND (fp_subfingerprints IS NOT NULL OR fingerprint IS NOT NULL)
+                    ORDER BY id
+                    LIMIT $2
+                    """,
+                    self._max_id,
+                    FP_INDEX_BATCH,
+                )
+                if not rows:
+                    break
+                self._max_id = rows[-1]["id"]
+                for song_id, packed, postings in await asyncio.to_thread(self._prepare, rows):
+                    if song_id not in self._prints:
+                        self._insert(song_id, packed, postings)
+                        added += 1
+                if self.full:
+                    logger.warning(
+                        "Fingerprint index is full (%s songs); songs after id %s are not indexed",
+                        len(self), self._max_id,
+                    )
+                if len(rows) < FP_INDEX_BATCH:
+                    break
+            self._refreshed_at = time.monotonic()
+            if added:
+                logger.info("🟦Fingerprint index: +%s songs (%s total)", added, len(self))
+            return added
+
+    def match(self, packed: bytes, exclude: Optional[int] = None) -> Optional[Tuple[int, float]]:
+        """
+        Best near-duplicate for a packed print as (song_id, ber), or None.
+        Postings vote for (song, offset) pairs; the top few are scored by BER.
+        CPU-bound: call it through asyncio.to_thread. refresh only ever appends
+        (print first, then its postings), so a match running alongside is safe.
+        """
+        votes: Counter = Counter()
+        for pos, key in self._keys(unpack_subfingerprints(packed)):
+            for p in self._postings.get(key, ()):
+                song_id = p >> _POS_BITS
+                if song_id != exclude:
+                    votes[(song_id, (p & _POS_MASK) - pos)] += 1
+
+        best = None
+        for (song_id, offset), n in votes.most_common(NEAR_DUP_CANDIDATES):
+            if n < NEAR_DUP_MIN_VOTES:
+                break
+            other = self._prints[song_id]
+            ber, overlap = bit_error_rate(packed, other, offset)
+            shorter = min(len(packed), len(other)) // 4
+            if overlap < NEAR_DUP_MIN_OVERLAP * shorter or ber > NEAR_DUP_MAX_BER:
+                continue
+            if best is None or ber < best[1]:
+                best = (song_id, ber)
+        return best
+
+
+# shared by every identify in this process
+FP_INDEX = SubfingerprintIndex()
+
+
+async def fp_index_loop(pool, stop: asyncio.Event, interval: float = FP_INDEX_REFRESH_SECS):
+    """
+    Warms FP_INDEX at startup and keeps it caught up with new songs, so identify
+    jobs only ever read it (and never hold a connection while it backfills).
+    """
+    logger.info("fp_index_loop starting")
+    try:
+        while not stop.is_set():
+            try:
+                async with pool.acquire() as conn:
+                    await FP_INDEX.refresh(conn, force=True)
+            except Exception as e:
+                logger.warning("fingerprint index refresh failed: %s", e)
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+    except asyncio.CancelledError:
+        pass
+    finally:
+        logger.info("fp_index_loop exiting")
@@ -0,0 +1,98 @@
+"""
+Audio format negotiation. Each audio stage declares the representation it reads
+(GET /format on its service: codec, sample rate, channels), and whoever produces
+audio for that stage writes it in exactly that shape, once:
+
+    identify (acousti) -> the first audio stage's input: demucs, or whisper when no stems
+    demucs             -> whisper's input, for the vocal stem
+
+so nothing downstream re-decodes a 44.1 kHz stereo WAV just to resample it, and
+what sits in /shared_data is compact lossless FLAC. Formats travel to the
+services as "codec:rate:channels" specs. Declarations are fetched in the
+background (format_loop); until a service answers, its default is used.
+"""
+import asyncio
+import os
+import time
+import logging
+from typing import Dict, Tuple
+
+from services import SERVICES, STAGE_SERVICES
+
+logger = logging.getLogger("orchestrator")
+
+# used until (or whenever) a service can't tell us itself
+DEFAULT_STAGE_FORMATS = {
+    "demucs":  os.getenv("DEMUCS_INPUT_FORMAT",  "flac:44100:2"),
+    "whisper": os.getenv("WHISPER_INPUT_FORMAT", "flac:16000:1"),
+}
+# a redeployed service may declare something else; ask again now and then
+FORMAT_REFRESH_SECS = float(os.getenv("FORMAT_REFRESH_SECS", "600"))
+# a service that didn't answer (down, or busy: demucs/whisper block their loop while
+# they work) is asked again this much sooner; the default is used meanwhile
+FORMAT_RETRY_SECS = float(os.getenv("FORMAT_RETRY_SECS", "60"))
+T_FORMAT = (2.0, 5.0)
+
+# stage -> (when to ask again, spec); only format_loop writes it, so jobs never wait on a
+# service's /format
+_declared: Dict[str, Tuple[float, str]] = {}
+
+
+def format_spec(declared: dict) -> str:
+    return f"{declared['codec']}:{int(declared['rate'])}:{int(declared['channels'])}"
+
+
+async def refresh_stage_format(stage: str) -> None:
+    """Ask the stage's service what it reads; on failure keep what we had for a while."""
+    cached = _declared.get(stage)
+    try:
+        r = await SERVICES[STAGE_SERVICES[stage]].client.get("/format", timeout=T_FORMAT)
+        r.raise_for_status()
+        spec = format_spec(r.json())
+    except Exception as e:
+        spec = cached[1] if cached else DEFAULT_STAGE_FORMATS[stage]
+        logger.warning("Could not get %s's input format (%s); using %s", stage, e, spec)
+        _declared[stage] = (time.monotonic() + FORMAT_RETRY_SECS, spec)
+        return
+    if not cached or cached[1] != spec:
+        logger.info("🟦%s reads %s", stage, spec)
+    _declared[stage] = (time.monotonic() + FORMAT_REFRESH_SECS, spec)
+
+
+async def format_loop(stop: asyncio.Event):
+    """Keeps every audio stage's declared input format fresh, off the job path."""
+    logger.info("format_loop starting")
+    try:
+        while not stop.is_set():
+            now = time.monotonic()
+            due = [s for s in DEFAULT_STAGE_FORMATS if _declared.get(s, (0.0,))[0] <= now]
+            await asyncio.gather(*(refresh_stage_format(s) for s in due))
+            next_due = min(_declared[s][0] for s in DEFAULT_STAGE_FORMATS)
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=max(1.0, next_due - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+    except asyncio.CancelledError:
+        pass
+    finally:
+        logger.info("format_loop exiting")
+
+
+def stage_format(stage: str) -> str:
+    """The "codec:rate:channels" the stage's service wants to read, as last declared."""
+    cached = _declared.get(stage)
+    return cached[1] if cached else DEFAULT_STAGE_FORMATS[stage]
+
+
+def identify_output_format(job) -> str:
+    """What acousti should write for this job: the next audio stage's input, or nothing."""
+    if job["want_demucs"]:
+        return stage_format("demucs")
+    if job["want_whisper"]:
+        return stage_format("whisper")
+    return ""
+
+
+def stem_format() -> str:
+    # stems are only ever read by whisper, now or by a later job reusing the song
+    return stage_format("whisper")
@@ -1,6 +1,6 @@
 import json
 from fastapi import FastAPI, HTTPException, UploadFile, Form, File, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.encoders import jsonable_encoder
 from fastapi.concurrency import run_in_threadpool
@@ -8,12 +8,18 @@ import os
 from contextlib import asynccontextmanager
 from typing import List, Optional
 import asyncio
+import random
 import asyncpg
 from services import (
     run_demucs, 
     run_whisper, 
     run_classify, 
     run_acousti,
+    service_metrics,
+    close_service_clients,
+    stage_claimable,
+    stage_retry_after,
+    ServiceUnavailable,
 )
 import traceback
 from utils import (
@@ -22,18 +28,54 @@ from utils import (
     RAW_PATH,
     FRONTEND_ORIGIN, 
     save_uploaded_file, 
-    compute_fingerprint_hash
+    UploadTooLarge,
+    remove_file_quietly,
+    compute_fingerprint_hash,
+    encode_song_cursor,
+    decode_song_cursor,
 )
 from db import (
-    update_job,
+    run_stage_statement,
+    LeaseLost,
+    statement_metrics,
+    setup_db_pool,
     lifespan,
-    upsert_song,
     dsn,
+    JOBS_CHANNEL,
+    STAGES,
+    RUNNABLE_STATUSES,
+    RUNNABLE_STATUSES_SQL,
     create_job,
+    heartbeat_job,
+    release_claim,
+    requeue_expired_leases,
+    release_orphaned_followers,
+    record_stage_failure,
+    ensure_archive_partitions,
+    archive_finished_jobs,
+    drop_expired_archive_partitions,
+    get_job as load_job,
+    get_job_status,
+    TERMINAL_STATUSES,
+    list_songs_page,
+    find_song_by_content_hash,
+    find_live_job_by_content_hash,
+    lock_fingerprint_leader,
+    get_song_cached,
+    get_song_by_fingerprint_hash_cached,
+    SONGS_CHANNEL,
+    singleton_lock,
+    queue_depths,
+    SONG_HEAVY_COLUMNS,
     get_song_by_title_artist,
     get_song_by_fingerprint_hash,
     search_song_fuzzy
 )
+from events import JobEventBroker
+from fingerprints import FP_INDEX, fp_index_loop, decode_fingerprint, pack_subfingerprints
+from cache import SONG_CACHE
+from formats import format_loop, identify_output_format, stem_format
+from responses import json_response, make_etag
 import logging
 
 logging.basicConfig(
@@ -42,33 +84,126 @@ logging.basicConfig(
 )
 logger = logging.getLogger("orchestrator")
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # --- Startup ---
-    app.state.db_pool = await asyncpg.create_pool(dsn=dsn)
+# Workers wake on NOTIFY; this slow poll is only a safety net for missed notifications
+WORKER_FALLBACK_POLL_SECS = float(os.getenv("WORKER_FALLBACK_POLL_SECS", "10"))
+LISTENER_RETRY_SECS = float(os.getenv("LISTENER_RETRY_SECS", "5"))
+
+# A claimed stage is leased for LEASE_SECS and re-upped by heartbeats every LEASE_SECS/3.
+# The reaper requeues jobs whose lease ran out (e.g. orchestrator died mid-Demucs).
+LEASE_SECS = float(os.getenv("LEASE_SECS", "60"))
+REAPER_INTERVAL_SECS = float(os.getenv("REAPER_INTERVAL_SECS", "30"))
+
+# A failed stage is retried up to MAX_STAGE_ATTEMPTS times with jittered exponential
+# backoff (RETRY_BASE_SECS doubling, capped at RETRY_MAX_SECS), then dead-lettered as 'Dead'
+MAX_STAGE_ATTEMPTS = int(os.getenv("MAX_STAGE_ATTEMPTS", "5"))
+RETRY_BASE_SECS = float(os.getenv("RETRY_BASE_SECS", "5"))
+RETRY_MAX_SECS = float(os.getenv("RETRY_MAX_SECS", "600"))
+
+# errors retrying can't fix (e.g. the input file is gone)
+PERMANENT_ERRORS = (FileNotFoundError,)
+
+# Finished jobs untouched for JOB_ARCHIVE_AFTER_SECS move to jobs_archive every
+# JOB_ARCHIVE_INTERVAL_SECS; archive partitions older than JOB_RETENTION_DAYS are dropped
+JOB_ARCHIVE_INTERVAL_SECS = float(os.getenv("JOB_ARCHIVE_INTERVAL_SECS", "3600"))
+JOB_ARCHIVE_AFTER_SECS = float(os.getenv("JOB_ARCHIVE_AFTER_SECS", "86400"))
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "180"))
+
+# /api/jobs/{job_id}/events: keep-alive comment interval, and how often to re-read the
+# job in case a notification was missed (e.g. while the LISTEN connection reconnected)
+SSE_KEEPALIVE_SECS = float(os.getenv("SSE_KEEPALIVE_SECS", "15"))
+SSE_RESYNC_SECS = float(os.getenv("SSE_RESYNC_SECS", "60"))
+
+# GET /api/songs page size
+SONGS_PAGE_DEFAULT = int(os.getenv("SONGS_PAGE_DEFAULT", "50"))
+SONGS_PAGE_MAX = int(os.getenv("SONGS_PAGE_MAX", "200"))
+
+# Concurrent jobs per stage; size each to what the downstream service can actually run at once
+STAGE_WORKERS = {
+    "identify": int(os.getenv("IDENTIFY_WORKERS", "2")),
+    "demucs":   int(os.getenv("DEMUCS_WORKERS",   "1")),
+    "whisper":  int(os.getenv("WHISPER_WORKERS",  "1")),
+    "classify": int(os.getenv("CLASSIFY_WORKERS", "2")),
+}
 
+# "all": serve HTTP and run the pipeline in one process (default).
+# "api": serve HTTP only -- run the pipeline with `python worker.py` instead, as many
+# replicas as needed; they share the queue through SKIP LOCKED claims and advisory locks
+ORCHESTRATOR_MODE = os.getenv("ORCHESTRATOR_MODE", "all").lower()
+
+def start_background_tasks(state, *, workers: bool = True, stages=STAGES) -> list[asyncio.Task]:
+    """
+    Start the LISTEN loop and, with `workers`, the per-stage worker pools plus the
+    reaper and archiver. Everything they share is hung off `state` (app.state or
+    the worker process's namespace). Stop them with stop_background_tasks(state).
+    """
     # create a stop event that signals workers to exit
-    app.state.stop_event = asyncio.Event()
+    state.stop_event = asyncio.Event()
 
-    # Optionally run multiple workers for concurrency
-    worker_count = 3  # bump if you want N workers
-    app.state.worker_tasks = [
-        asyncio.create_task(worker_loop(app.state.db_pool, app.state.stop_event))
-        for _ in range(worker_count)
+    # one event per stage, set by the LISTEN connection when a job becomes runnable there
+    state.job_ready = {stage: asyncio.Event() for stage in STAGES}
+    # fans the same notifications out to /api/jobs/{job_id}/events subscribers
+    state.job_events = JobEventBroker()
+    tasks = [
+        asyncio.create_task(listen_loop(state.job_ready, state.job_events, state.stop_event))
     ]
+    if workers:
+        # Separate worker pool per stage so slow stages (demucs) can't starve cheap ones
+        tasks += [
+            asyncio.create_task(
+                worker_loop(state.db_pool, state.stop_event, state.job_ready[stage], stage, STAGE_WORKERS[stage])
+            )
+            for stage in stages
+            if STAGE_WORKERS[stage] > 0
+        ]
+        # safe on every replica: each pass only runs under its advisory lock
+        tasks.append(asyncio.create_task(reaper_loop(state.db_pool, state.stop_event)))
+        tasks.append(asyncio.create_task(archiver_loop(state.db_pool, state.stop_event)))
+        if {"identify", "demucs"} & set(stages):
+            # those stages write audio in the format the next one declared
+            tasks.append(asyncio.create_task(format_loop(state.stop_event)))
+        if "identify" in stages:
+            # near-duplicate lookups read the in-memory fingerprint index
+            tasks.append(asyncio.create_task(fp_index_loop(state.db_pool, state.stop_event)))
+    state.background_tasks = tasks
+    return tasks
+
+async def stop_background_tasks(state) -> None:
+    # signal workers to stop and wait them out
+    state.stop_event.set()
+    for ev in state.job_ready.values():
+        ev.set()
+    for t in state.background_tasks:
+        t.cancel()
+    # gather with return_exceptions=True so one CancelledError doesn't abort others
+    await asyncio.gather(*state.background_tasks, return_exceptions=True)
+
+# /api/analyze answers 503 "busy" up front when a stage the request needs already has
+# this many jobs waiting (e.g. its service is down and its breaker keeps them queued)
+STAGE_MAX_QUEUE = {
+    "identify": int(os.getenv("IDENTIFY_MAX_QUEUE", "200")),
+    "demucs":   int(os.getenv("DEMUCS_MAX_QUEUE",   "50")),
+    "whisper":  int(os.getenv("WHISPER_MAX_QUEUE",  "50")),
+    "classify": int(os.getenv("CLASSIFY_MAX_QUEUE", "200")),
+}
+QUEUE_DEPTH_CACHE_SECS = float(os.getenv("QUEUE_DEPTH_CACHE_SECS", "2"))
+BUSY_RETRY_AFTER_SECS = int(os.getenv("BUSY_RETRY_AFTER_SECS", "30"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # --- Startup ---
+    # pool connections come with the stage statements already prepared (db.init_connection)
+    app.state.db_pool = await setup_db_pool(dsn)
+    # the LISTEN loop runs either way: progress streams and cache invalidation need it
+    start_background_tasks(app.state, workers=ORCHESTRATOR_MODE != "api")
+    logger.info("orchestrator mode: %s", ORCHESTRATOR_MODE)
 
     try:
         # Yield control back to FastAPI—startup completes immediately (non-blocking)
         yield
     finally:
         # --- Shutdown ---
-        # signal workers to stop and wait them out
-        app.state.stop_event.set()
-        for t in app.state.worker_tasks:
-            t.cancel()
-        # gather with return_exceptions=True so one CancelledError doesn't abort others
-        await asyncio.gather(*app.state.worker_tasks, return_exceptions=True)
-
+        await stop_background_tasks(app.state)
+        await close_service_clients()
         await app.state.db_pool.close()
 
 
@@ -83,53 +218,275 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-async def worker_loop(pool: asyncpg.Pool, stop: asyncio.Event, poll_interval: float = 0.5):
-    logger.info("worker_loop starting")
+def on_job_notification(job_ready: dict[str, asyncio.Event], events: JobEventBroker, payload: str):
+    """NOTIFY callback: wake the right worker pool and fan the event out to progress streams."""
+    try:
+        msg = json.loads(payload)
+    except (TypeError, ValueError):
+        msg = None
+
+    wake_workers(job_ready, msg)
+    if isinstance(msg, dict):
+        events.publish(msg)
+
+def on_song_notification(payload: str):
+    """NOTIFY callback: a song row changed somewhere, drop it from SONG_CACHE."""
+    try:
+        msg = json.loads(payload)
+        SONG_CACHE.invalidate(msg.get("id"), msg.get("fingerprint_hash"))
+    except (TypeError, ValueError, AttributeError):
+        SONG_CACHE.clear()
+
+def wake_workers(job_ready: dict[str, asyncio.Event], msg: Optional[dict]):
+    """
+    Wake the pool for the job's next stage.
+    Anything we can't parse wakes every pool (they'll just find nothing to claim).
+    """
+    if not isinstance(msg, dict):
+        for ev in job_ready.values():
+            ev.set()
+        return
+
+    stage = msg.get("next_stage")
+    if msg.get("status") in RUNNABLE_STATUSES and stage in job_ready:
+        job_ready[stage].set()
+
+async def listen_loop(
+    job_ready: dict[str, asyncio.Event],
+    events: JobEventBroker,
+    stop: asyncio.Event,
+):
+    """
+    Holds one dedicated connection LISTENing on JOBS_CHANNEL; every notification wakes
+    the matching stage's workers and is published to `events`. Also LISTENs on
+    SONGS_CHANNEL to invalidate SONG_CACHE. Reconnects if the connection drops.
+    """
+    logger.info("listen_loop starting")
     try:
         while not stop.is_set():
-            async with pool.acquire() as conn:
+            conn = None
+            try:
+                conn = await asyncpg.connect(dsn=dsn)
+                closed = asyncio.Event()
+                conn.add_termination_listener(lambda _conn: closed.set())
+                await conn.add_listener(
+                    JOBS_CHANNEL,
+                    lambda _conn, _pid, _channel, payload: on_job_notification(job_ready, events, payload),
+                )
+                await conn.add_listener(
+                    SONGS_CHANNEL,
+                    lambda _conn, _pid, _channel, payload: on_song_notification(payload),
+                )
+                # anything queued while we weren't listening gets picked up now,
+                # and any song invalidation we missed is covered by starting cold
+                for ev in job_ready.values():
+                    ev.set()
+                SONG_CACHE.clear()
+                await closed.wait()
+                logger.warning("LISTEN connection closed, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("LISTEN connection failed: %s", e)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(LISTENER_RETRY_SECS)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        logger.info("listen_loop exiting")
+
+async def worker_loop(
+    pool: asyncpg.Pool,
+    stop: asyncio.Event,
+    job_ready: asyncio.Event,
+    stage: Optional[str] = None,
+    concurrency: int = 1,
+    poll_interval: float = WORKER_FALLBACK_POLL_SECS,
+):
+    """
+    Worker pool for one stage: claims as many jobs as it has free slots in a single
+    round trip and runs up to `concurrency` of them at once.
+    """
+    logger.info("worker_loop starting (stage=%s, concurrency=%s)", stage or "any", concurrency)
+    loop = asyncio.get_running_loop()
+    running: set[asyncio.Task] = set()
+
+    def on_done(task: asyncio.Task):
+        running.discard(task)
+        # a slot freed up
+        job_ready.set()
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.error("Job task crashed: %s", task.exception())
+            return
+        result = task.result()
+        if result and result[0] == "retry":
+            # backed-off jobs don't NOTIFY when they become due; wake ourselves instead
+            loop.call_later(result[2], job_ready.set)
+
+    try:
+        while not stop.is_set():
+            # clear before claiming so a NOTIFY that lands mid-claim isn't lost
+            job_ready.clear()
+            free = concurrency - len(running)
+            claimable = stage_claimable(stage, free) if stage else free
+            if free > 0 and claimable == 0:
+                # service's breaker is open: leave the jobs queued (nothing claimed, no
+                # attempts burned) and look again when it lets a probe through
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=stage_retry_after(stage))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            free = claimable
+            if free > 0:
                 try:
-                    job = await process_job(conn)
+                    async with pool.acquire() as conn:
+                        jobs = await claim_jobs(conn, free, stage)
                 except Exception as e:
                     # DB hiccup: brief backoff, keep loop healthy
+                    logger.warning("claim failed (stage=%s): %s", stage or "any", e)
                     await asyncio.sleep(1.0)
                     continue
 
-                if not job:
-                    # No work right now; wait a bit, but wake up early if stopping
-                    try:
-                        await asyncio.wait_for(stop.wait(), timeout=poll_interval)
-                    except asyncio.TimeoutError:
-                        pass
-                    continue
+                for job in jobs:
+                    task = asyncio.create_task(run_job(pool, job))
+                    running.add(task)
+                    task.add_done_callback(on_done)
+
+            # Sleep until NOTIFY, a slot frees up, or the fallback poll
+            try:
+                await asyncio.wait_for(job_ready.wait(), timeout=poll_interval)
+            except asyncio.TimeoutError:
+                pass
                 
     except asyncio.CancelledError:
         # Allow task cancellation to be graceful
         pass
     finally:
-        logger.info("worker_loop exiting")
+        # in-flight stages hand their jobs back to the queue as they're cancelled (run_job);
+        # if we die before that, the reaper requeues them once the lease runs out
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        logger.info("worker_loop exiting (stage=%s)", stage or "any")
+
+async def reaper_loop(pool: asyncpg.Pool, stop: asyncio.Event, interval: float = REAPER_INTERVAL_SECS):
+    """
+    Periodically requeue jobs whose worker stopped heartbeating, and single-flight
+    followers left 'Waiting' on a leader that is gone.
+    """
+    logger.info("reaper_loop starting")
+    try:
+        while not stop.is_set():
+            try:
+                reaped = orphans = None
+                async with pool.acquire() as conn:
+                    async with singleton_lock(conn, "reaper") as leader:
+                        if leader:
+                            reaped = await requeue_expired_leases(conn, MAX_STAGE_ATTEMPTS)
+                            orphans = await release_orphaned_followers(conn)
+                if reaped:
+                    logger.warning("Requeued jobs with expired leases: %s", reaped)
+                if orphans:
+                    logger.warning("Requeued followers whose leader is gone: %s", orphans)
+            except Exception as e:
+                logger.warning("reaper pass failed: %s", e)
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+    except asyncio.CancelledError:
+        pass
+    finally:
+        logger.info("reaper_loop exiting")
+
+async def archiver_loop(pool: asyncpg.Pool, stop: asyncio.Event, interval: float = JOB_ARCHIVE_INTERVAL_SECS):
+    """Periodically move finished jobs to jobs_archive and drop expired archive partitions."""
+    logger.info("archiver_loop starting")
+    try:
+        while not stop.is_set():
+            try:
+                moved = dropped = None
+                async with pool.acquire() as conn:
+                    async with singleton_lock(conn, "archiver") as leader:
+                        if leader:
+                            await ensure_archive_partitions(conn)
+                            moved = await archive_finished_jobs(conn, JOB_ARCHIVE_AFTER_SECS)
+                            dropped = await drop_expired_archive_partitions(conn, JOB_RETENTION_DAYS)
+                if moved or dropped:
+                    logger.info("Archived %s jobs, dropped partitions: %s", moved, dropped)
+            except Exception as e:
+                logger.warning("archiver pass failed: %s", e)
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+    except asyncio.CancelledError:
+        pass
+    finally:
+        logger.info("archiver_loop exiting")
 
-async def process_job(conn):
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff for the given failed-attempt count, with jitter over the upper half."""
+    delay = min(RETRY_MAX_SECS, RETRY_BASE_SECS * (2 ** (attempts - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+async def heartbeat_loop(
+    pool: asyncpg.Pool, job_id: int, claimed_at, owner: asyncio.Task, lease_secs: float = LEASE_SECS
+):
+    """
+    Keeps a claimed job's lease alive while its stage runs. Cancelled when the stage ends.
+    If the lease is lost anyway, cancels `owner` (the run_job task): the job is someone
+    else's now, so there is no point finishing the stage.
     """
-    Claims one job, runs exactly one needed stage based on want/done flags,
+    while True:
+        await asyncio.sleep(lease_secs / 3)
+        try:
+            async with pool.acquire() as conn:
+                still_ours = await heartbeat_job(conn, job_id, claimed_at, lease_secs)
+        except Exception as e:
+            logger.warning("heartbeat for job %s failed: %s", job_id, e)
+            continue
+        if not still_ours:
+            logger.warning("Lost lease on job %s; abandoning its stage", job_id)
+            owner.cancel()
+            return
+
+async def release_job(pool: asyncpg.Pool, job: dict) -> None:
+    async with pool.acquire() as conn:
+        if await release_claim(conn, job["id"], job["claimed_at"]):
+            logger.info("🟦Released job %s back to the queue", job["id"])
+
+async def run_job(pool: asyncpg.Pool, job: dict):
+    """
+    Runs exactly one needed stage of an already-claimed job based on want/done flags,
     then advances (or completes) the job. Returns (job_id, stage) or None if no work.
+
+    Stage execution and write-back each use their own short pool checkout,
+    so no connection is held while a downstream service is working.
     """
-    job = await get_and_claim_job(conn)
-    if not job:
-        return None
     logger.info("🟦Processing Job")
+    heartbeat = asyncio.create_task(
+        heartbeat_loop(pool, job["id"], job["claimed_at"], asyncio.current_task())
+    )
+    stage = job["current_stage"]
     try:
-        stage = job["current_stage"]
         file_path= job["file_path"]
         input_type = job["input_type"]
         if not stage:
             # Nothing to do — finalize as complete just in case
-            await conn.execute("UPDATE jobs SET status='Complete' WHERE id=$1", job["id"])
+            async with pool.acquire() as conn:
+                await conn.execute("UPDATE jobs SET status='Complete' WHERE id=$1", job["id"])
             return None
         # Run one stage
         
         if stage == "identify":
-            acousti_out = await run_acousti(file_path)
+            # written straight in the format the next audio stage reads, if there is one
+            acousti_out = await run_acousti(file_path, identify_output_format(job))
             
             matches = acousti_out.get("matches", [])
             title = matches[0].get("title") if matches else "Unknown"
@@ -142,26 +499,32 @@ async def process_job(conn):
             job["fp_hash"] = fp_hash
             if not fp_hash:
             # fingerprint failed — mark job failed early
-                await update_job(conn, job_id=job["id"], status="Failed")
+                async with pool.acquire() as conn:
+                    await run_stage_statement(conn, "job_identify_failed", job["id"], job["claimed_at"])
                 logger.error("no fingerprint generated")
                 return
-            song = await get_song_by_fingerprint_hash(conn, fp_hash)
+            try:
+                job["fp_packed"] = pack_subfingerprints(decode_fingerprint(fp))
+            except ValueError as e:
+                logger.warning("Could not decode fingerprint for job %s: %s", job["id"], e)
+                job["fp_packed"] = None
+            song = await get_song_by_fingerprint_hash_cached(pool, fp_hash)
+            if not song and job["fp_packed"]:
+                # same recording, different bytes (encode, bitrate, trimmed intro)?
+                # fp_index_loop keeps the index current; reading it needs no connection
+                near = await asyncio.to_thread(FP_INDEX.match, job["fp_packed"])
+                if near:
+                    logger.info("🟦Near-duplicate of song %s (BER %.3f)", near[0], near[1])
+                    song = await get_song_cached(pool, near[0])
             
             if(not job["want_demucs"]):
                 if(song and song["id"]):
-                    await conn.execute(
-                    """
-                    UPDATE jobs
-                    SET
-                    status  = 'Completed',
-                    song_id = COALESCE($2, song_id)
-                    WHERE id = $1
-                    """,
-                    job["id"],
-                    song["id"],
-                    )
-                    song_id = await finalize_job_if_ready(conn, job["id"])
-                    return ("completed", song_id)
+                    # already have this song: point the job at it and stop here
+                    async with pool.acquire() as conn:
+                        await run_stage_statement(
+                            conn, "job_identify_known_song", job["id"], song["id"], job["claimed_at"]
+                        )
+                    return ("completed", song["id"])
                 
             #logger.info(job["want_demucs"])
             if(job["want_demucs"]):
@@ -197,212 +560,236 @@ async def process_job(conn):
 
             logger.info(f"{job}")
                 
-            await update_job(
-                conn,
-                job_id=job["id"],
-                title=title,
-                artist=artist,
-                accuracy=job["accuracy"],
-                classification=job["classification"],
-                lyrics=job["lyrics"],
-                
-                duration=acousti_out.get("duration"),
-                fingerprint=job["fp"],
-                fingerprint_hash=job["fp_hash"],
-                file_path=job["file_path"],
-                done_identify= True,
-                done_demucs= job["done_demucs"],
-                done_classify=job["done_classify"],
-                done_whisper=job["done_whisper"],
-                status="Not Started",
-                current_stage=job["current_stage"]
-                
+            statement, args = "job_identify_done", (
+                title,
+                artist,
+                acousti_out.get("duration"),
+                job["fp"],
+                job["fp_hash"],
+                job["file_path"],
+                job["lyrics"],
+                job["classification"],
+                job["accuracy"],
+                job["done_demucs"],
+                job["done_whisper"],
+                job["done_classify"],
+                job["current_stage"],
             )
                
         elif stage == "demucs":
-            demucs_out = await run_demucs(file_path)
+            demucs_out = await run_demucs(file_path, stem_format())
             
-            await update_job(
-                conn,
-                job_id=job["id"],
-                file_path=demucs_out.get("file_path"),
-                done_demucs= True,
-                status="Not Started",
-                current_stage="whisper"
-            )
+            statement, args = "job_demucs_done", (demucs_out.get("file_path"),)
             
             
         elif stage == "whisper":
             whisper_out = await run_whisper(file_path)
             
-            await update_job(
-                conn,
-                lyrics = whisper_out.get("lyrics"),
-                job_id=job["id"],
-                done_whisper= True,
-                status="Not Started",
-                current_stage="classify"
-            )
+            statement, args = "job_whisper_done", (whisper_out.get("lyrics"),)
             
             
         elif stage == "classify":
             lyrics=job["lyrics"]
             classify_out = await run_classify(lyrics)
             
-            await update_job(
-                conn,
-                job_id=job["id"],
-                done_classify= True,
-                classification= classify_out.get("classification"),
-                accuracy= classify_out.get("accuracy"),
-                status="Not Started",
-                current_stage="None"
+            statement, args = "job_classify_done", (
+                classify_out.get("classification"),
+                classify_out.get("accuracy"),
             )
         else:
             raise RuntimeError(f"Unknown stage: {stage}")
         
+        # write the stage result back, release the lease and promote to songs
+        # if this was the last stage -- one short checkout, one round trip
+        async with pool.acquire() as conn:
+            if stage == "identify":
+                # single-flight: if another live job already has this fingerprint and will run
+                # everything we still need, park behind it; complete_stage() hands us its results
+                async with conn.transaction():
+                    leader_id = None
+                    if job["current_stage"] != "None":
+                        leader_id = await lock_fingerprint_leader(
+                            conn,
+                            job["id"],
+                            job["fp_hash"],
+                            want_demucs=job["want_demucs"] and not job["done_demucs"],
+                            want_whisper=job["want_whisper"] and not job["done_whisper"],
+                            want_classify=job["want_classify"] and not job["done_classify"],
+                        )
+                    song_id = await run_stage_statement(
+                        conn, statement, job["id"], *args, leader_id, job["fp_packed"], job["claimed_at"]
+                    )
+                if leader_id:
+                    logger.info("🟦Job %s waiting on job %s for the same fingerprint", job["id"], leader_id)
+            else:
+                song_id = await run_stage_statement(conn, statement, job["id"], *args, job["claimed_at"])
         logger.info("🟦Job Processed Successfully")
-        song_id = await finalize_job_if_ready(conn, job["id"])
         if song_id:
+            # complete_stage() upserted the song; the trigger NOTIFY covers other
+            # replicas, but don't serve our own stale copy until it arrives
+            SONG_CACHE.invalidate(song_id, job.get("fp_hash") or job.get("fingerprint_hash"))
             return ("completed", song_id)   # promoted to songs; job was deleted
         else:
             return ("in_progress", job["id"])  # more stages remain
 
+    except LeaseLost as e:
+        # reaped while we worked; whoever holds the job now does the stage
+        logger.warning("%s; result discarded", e)
+        return ("lost", job["id"])
+    except asyncio.CancelledError:
+        if heartbeat.done() and not heartbeat.cancelled():
+            # heartbeat_loop only returns after losing the lease and cancelling us
+            logger.warning("Job %s: stage abandoned after losing its lease", job["id"])
+            return ("lost", job["id"])
+        # shutting down: hand the job straight back rather than leaving it for the
+        # reaper, which would count the expired lease as a failed attempt
+        try:
+            await asyncio.shield(release_job(pool, job))
+        except Exception as e:
+            logger.warning("Could not release job %s on shutdown: %s", job["id"], e)
+        raise
     except Exception as e:
-        logger.error("Job %s failed at stage=%s. Error: %s", job["id"], job.get("current_stage"), e)
+        # only this stage is retried; done_* flags keep earlier stages' results.
+        # a breaker that opened after we claimed isn't the job's fault: no attempt spent
+        unavailable = isinstance(e, ServiceUnavailable)
+        attempts = (job.get("attempts") or 0) + (0 if unavailable else 1)
+        dead = not unavailable and (attempts >= MAX_STAGE_ATTEMPTS or isinstance(e, PERMANENT_ERRORS))
+        if dead:
+            retry_in = None
+        else:
+            retry_in = e.retry_after if unavailable else retry_delay(attempts)
+        logger.error(
+            "Job %s failed at stage=%s (attempt %s/%s). Error: %s",
+            job["id"], stage, attempts, MAX_STAGE_ATTEMPTS, e,
+        )
         try:
-            await conn.execute("UPDATE jobs SET status='Failed' WHERE id=$1", job["id"])
+            async with pool.acquire() as conn:
+                await record_stage_failure(
+                    conn,
+                    job["id"],
+                    attempts=attempts,
+                    error=f"{stage}: {type(e).__name__}: {e}",
+                    retry_in=retry_in,
+                    claimed_at=job["claimed_at"],
+                )
+        except LeaseLost:
+            logger.warning("Job %s: lease lost before its failure was recorded", job["id"])
+            return ("lost", job["id"])
         except Exception:
-            logger.exception("Also failed to mark job %s as Failed", job["id"])
-        raise
-
-
-def job_is_complete(job: dict) -> bool:
-    """A job is complete when every wanted stage is done or is marked as complete."""
-    wants_dones = [
-        ("identify", job["want_identify"], job["done_identify"]),
-        ("demucs",   job["want_demucs"],   job["done_demucs"]),
-        ("whisper",  job["want_whisper"],  job["done_whisper"]),
-        ("classify", job["want_classify"], job["done_classify"]),
-    ]
-    return all((not want) or done for _, want, done in wants_dones)
-
-async def finalize_job_if_ready(conn, job_id: int) -> int | None:
-    """
-    If the job has completed all requested stages:
-      1) INSERT its data into songs
-      2) DELETE the job
-    Returns the new song_id (or existing song_id if already set), else None.
-    """
-    logger.info("🟦looking to see if request is complete")
-    job = await conn.fetchrow("SELECT * FROM jobs WHERE id=$1 FOR UPDATE", job_id)
-    
-    if not job:
-        return None
-
-    if not job_is_complete(job):
-        return None
-    
-    logger.info("🟦Request Complete, Adding to Database")
-    
-
-
-    async with conn.transaction():
-    # lock the job row
-        job = await conn.fetchrow("SELECT * FROM jobs WHERE id=$1 FOR UPDATE", job_id)
-        if not job or not job_is_complete(job):
-            return None
-
-        # build params for upsert_song from the job
-        
-
-        song_fields = {
-            "title": job["title"],
-            "artist": job["artist"],
-            "duration": int(job["duration"]) if job["duration"] is not None else None,
-            "fingerprint": job["fingerprint"],
-            "fingerprint_hash": job["fingerprint_hash"],
-            "lyrics": job["lyrics"],
-            "classification": job["classification"],
-            "accuracy": float(job["accuracy"]) if job["accuracy"] is not None else None,
-            "file_path": job["file_path"],
-            "audio_processed": bool(job["audio_processed"]),
-        }
-
-    song_id = await upsert_song(conn, **song_fields)
-    #await conn.execute("DELETE FROM jobs WHERE id=$1", job_id)
-    await conn.execute(
-        """
-        UPDATE jobs
-        SET
-        status  = 'Completed',
-        song_id = COALESCE($2, song_id)
-        WHERE id = $1
-        """,
-        job_id,
-        song_id,
-        
-    )
-
-
-
+            logger.exception("Also failed to record failure for job %s", job["id"])
+            raise
+        if dead:
+            logger.error("Job %s dead-lettered at stage=%s", job["id"], stage)
+            return ("dead", job["id"])
+        return ("retry", job["id"], retry_in)
+    finally:
+        heartbeat.cancel()
 
-    logger.info("🟦Request Successfully Added to Database")
-    return song_id
 
-async def get_and_claim_job(conn):
+async def claim_jobs(conn, n: int, stage: Optional[str] = None) -> list[dict]:
     """
-    Atomically pick ONE pending job and mark it 'Claimed' with the next current_stage.
+    Atomically pick up to `n` pending jobs in one round trip and mark them 'Claimed'
+    with their next stage. Runs off the idx_jobs_runnable partial index on the
+    generated next_stage column, so cost doesn't grow with job history.
     Uses SKIP LOCKED so multiple workers don't collide.
     """
-    sql = """
+    stage_pred = "j.next_stage = $4::text" if stage else "j.next_stage IS NOT NULL"
+    sql = f"""
     WITH candidate AS (
-      SELECT j.id,
-             CASE
-               WHEN j.want_identify AND NOT j.done_identify THEN 'identify'
-               WHEN j.want_demucs   AND NOT j.done_demucs   THEN 'demucs'
-               WHEN j.want_whisper  AND NOT j.done_whisper  THEN 'whisper'
-               WHEN j.want_classify AND NOT j.done_classify THEN 'classify'
-               ELSE NULL
-             END AS next_stage
+      SELECT j.id
       FROM jobs j
-      WHERE j.status IN ('Not Started','Queued','In Progress')
-        AND (
-          (j.want_identify AND NOT j.done_identify) OR
-          (j.want_demucs   AND NOT j.done_demucs)   OR
-          (j.want_whisper  AND NOT j.done_whisper)  OR
-          (j.want_classify AND NOT j.done_classify)
-        )
+      WHERE j.status IN ({RUNNABLE_STATUSES_SQL})
+        AND {stage_pred}
+        AND (j.next_attempt_at IS NULL OR j.next_attempt_at <= now())
       ORDER BY j.id
       FOR UPDATE SKIP LOCKED
-      LIMIT 1
+      LIMIT $1
     ),
     upd AS (
       UPDATE jobs j
       SET status = 'Claimed',
-          current_stage = c.next_stage
+          current_stage = j.next_stage,
+          claimed_at = now(),
+          lease_expires_at = now() + make_interval(secs => $2)
       FROM candidate c
       WHERE j.id = c.id
       RETURNING j.*
     )
-    SELECT * FROM upd;
+    -- progress streams show the claimed stage; workers ignore 'Claimed' notifications
+    SELECT upd.*,
+           pg_notify($3, json_build_object(
+             'id', upd.id, 'status', upd.status, 'current_stage', upd.current_stage,
+             'next_stage', upd.next_stage, 'song_id', upd.song_id
+           )::text) AS _notified
+    FROM upd ORDER BY id;
     """
-    row = await conn.fetchrow(sql)
-    return dict(row) if row else None
+    args = (n, LEASE_SECS, JOBS_CHANNEL, stage) if stage else (n, LEASE_SECS, JOBS_CHANNEL)
+    rows = await conn.fetch(sql, *args)
+    jobs = []
+    for r in rows:
+        job = dict(r)
+        job.pop("_notified", None)
+        jobs.append(job)
+    return jobs
 
 
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
+@app.get("/metrics/statements")
+async def statements_metrics(request: Request):
+    """Call counts and latency of the named stage statements (not proxied under /api)."""
+    pool = request.app.state.db_pool
+    async with pool.acquire() as conn:
+        metrics = await statement_metrics(conn)
+    return JSONResponse(status_code=200, content=jsonable_encoder(metrics))
+
+@app.get("/metrics/cache")
+async def cache_metrics():
+    """Hit/miss counters of the in-process song cache."""
+    return JSONResponse(status_code=200, content=SONG_CACHE.stats())
+
+@app.get("/metrics/services")
+async def services_metrics():
+    """Adaptive concurrency limit, in-flight and waiting calls per downstream service."""
+    return JSONResponse(status_code=200, content=service_metrics())
+
 @app.get("/api/songs")
-async def list_songs(request: Request):
+async def list_songs(
+    request: Request,
+    limit: int = SONGS_PAGE_DEFAULT,
+    cursor: Optional[str] = None,
+    fields: str = "",
+):
+    """
+    Newest songs first, one page at a time. Returns a summary projection; heavy columns
+    (lyrics, fingerprint, ...) only via `fields=lyrics,fingerprint`. When there is more,
+    the X-Next-Cursor response header holds the `cursor=` for the next page.
+    """
     try:
+        limit = max(1, min(limit, SONGS_PAGE_MAX))
+        wanted = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in wanted if f not in SONG_HEAVY_COLUMNS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+        try:
+            after = decode_song_cursor(cursor) if cursor else None
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
         pool = request.app.state.db_pool
         async with pool.acquire() as conn:
-            rows = await conn.fetch("SELECT * FROM songs ORDER BY created_at DESC")
-            result = [dict(row) for row in rows]
-            return JSONResponse(status_code=200, content=jsonable_encoder(result))
+            result = await list_songs_page(conn, limit=limit, after=after, fields=wanted)
+
+        headers = {}
+        if len(result) == limit:
+            last = result[-1]
+            headers["X-Next-Cursor"] = encode_song_cursor(last["created_at"], last["id"])
+        # a page has no single updated_at, so its ETag is a hash of the encoded body
+        return json_response(request, result, headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         print("❌ DB error in GET /songs:", e)
         return JSONResponse(
@@ -414,15 +801,17 @@ async def list_songs(request: Request):
 async def get_job(request: Request, song_id: int):
     try:
         pool = request.app.state.db_pool
-        async with pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT * FROM songs WHERE id = $1", song_id)
-            if not row:
-                raise HTTPException(status_code=404, detail="Song not found")
+        row = await get_song_cached(pool, song_id)
+        if not row:
+            raise HTTPException(status_code=404, detail="Song not found")
 
-            return JSONResponse(
-                status_code=200,
-                content=jsonable_encoder(dict(row))
-            )
+        # validators come from the cached row, so a 304 costs no query and no encoding
+        return json_response(
+            request,
+            row,
+            etag=make_etag("song", row["id"], row["updated_at"]),
+            last_modified=row["updated_at"],
+        )
     except HTTPException:
         raise
     except Exception as e:
@@ -436,15 +825,18 @@ async def get_job(request: Request, song_id: int):
 async def get_job(request: Request, job_id: int):
     try:
         pool = request.app.state.db_pool
-        async with pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT * FROM jobs WHERE id = $1", job_id)
-            if not row:
-                raise HTTPException(status_code=404, detail="Job not found")
+        # falls back to jobs_archive for jobs the archiver already moved
+        job = await load_job(pool, job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
 
-            return JSONResponse(
-                status_code=200,
-                content=jsonable_encoder(dict(row))
-            )
+        # updated_at is bumped by a trigger on every write to the job
+        return json_response(
+            request,
+            job,
+            etag=make_etag("job", job["id"], job["updated_at"], job.get("archived_at")),
+            last_modified=job["updated_at"],
+        )
     except HTTPException:
         raise
     except Exception as e:
@@ -454,6 +846,71 @@ async def get_job(request: Request, job_id: int):
             content={"error": "Database error"}
         )
 
+_backlog = {"at": 0.0, "depths": {}}
+
+async def stage_backlog(pool) -> dict:
+    """queue_depths(), re-read at most every QUEUE_DEPTH_CACHE_SECS so bursts of uploads share one query."""
+    now = asyncio.get_running_loop().time()
+    if now - _backlog["at"] >= QUEUE_DEPTH_CACHE_SECS:
+        async with pool.acquire() as conn:
+            _backlog["depths"] = await queue_depths(conn)
+        _backlog["at"] = now
+    return _backlog["depths"]
+
+def _sse(event: dict) -> str:
+    return f"event: job\ndata: {json.dumps(jsonable_encoder(event))}\n\n"
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(request: Request, job_id: int):
+    """
+    Server-Sent Events stream of a job's stage/status changes: one `job` event with the
+    current state, then one per transition, ending after a terminal status (the final
+    event carries song_id). Fed from the orchestrator's LISTEN connection, so open
+    streams cost no DB queries beyond the initial read and a slow resync.
+    """
+    pool = request.app.state.db_pool
+    broker: JobEventBroker = request.app.state.job_events
+
+    # subscribe before the snapshot so nothing between the two is lost
+    queue = broker.subscribe(job_id)
+    try:
+        async with pool.acquire() as conn:
+            snapshot = await get_job_status(conn, job_id)
+    except Exception:
+        broker.unsubscribe(job_id, queue)
+        raise
+    if not snapshot:
+        broker.unsubscribe(job_id, queue)
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def stream():
+        loop = asyncio.get_running_loop()
+        try:
+            event = snapshot
+            yield _sse(event)
+            last_sync = loop.time()
+            while event.get("status") not in TERMINAL_STATUSES:
+                if await request.is_disconnected():
+                    return
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECS)
+                except asyncio.TimeoutError:
+                    if loop.time() - last_sync < SSE_RESYNC_SECS:
+                        yield ": keep-alive\n\n"
+                        continue
+                    async with pool.acquire() as conn:
+                        event = await get_job_status(conn, job_id) or event
+                    last_sync = loop.time()
+                yield _sse(event)
+        finally:
+            broker.unsubscribe(job_id, queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.post("/api/analyze")
 async def analyze(
     request: Request,
@@ -472,14 +929,43 @@ async def analyze(
         want_whisper      = "lyrics" in outputs
         want_classify     = "classification" in outputs
         current_stage = None
-        
-        
+        content_hash = None
+
         if input_type=="audio":
             if not audio:
                 return {"success": False, "error": "Missing audio file for input_type 'audio'"}
-            raw_filename=save_uploaded_file(audio)
+            try:
+                raw_filename, content_hash = await save_uploaded_file(audio)
+            except UploadTooLarge as e:
+                return JSONResponse(status_code=413, content={"success": False, "error": str(e)})
             file_path = os.path.join(RAW_PATH, raw_filename)
 
+            # seen these exact bytes before? skip convert/fpcalc and the whole pipeline
+            async with db_pool.acquire() as conn:
+                song_id = await find_song_by_content_hash(
+                    conn,
+                    content_hash,
+                    want_demucs=want_demucs,
+                    want_whisper=want_whisper,
+                    want_classify=want_classify,
+                )
+                existing_job_id = None if song_id else await find_live_job_by_content_hash(
+                    conn,
+                    content_hash,
+                    want_identify=want_identify,
+                    want_demucs=want_demucs,
+                    want_whisper=want_whisper,
+                    want_classify=want_classify,
+                )
+            if song_id or existing_job_id:
+                await run_in_threadpool(remove_file_quietly, file_path)
+            if song_id:
+                logger.info("🟦Upload matches song %s by content hash", song_id)
+                return {"success": True, "song_id": song_id}
+            if existing_job_id:
+                logger.info("🟦Upload attached to in-flight job %s by content hash", existing_job_id)
+                return {"success": True, "job_id": existing_job_id}
+
 
         if input_type == "search":
             if not title or not artist:
@@ -500,6 +986,29 @@ async def analyze(
         if input_type == "text":
             file_path="delete"
 
+        # shed load only now that this request needs new pipeline work: re-uploads the
+        # content hash already answered never get a 503
+        if input_type in ("audio", "text"):
+            wanted = dict(zip(STAGES, (want_identify, want_demucs, want_whisper, want_classify)))
+            backlog = await stage_backlog(db_pool)
+            busy = [
+                stage for stage, want in wanted.items()
+                if want and backlog.get(stage, 0) >= STAGE_MAX_QUEUE[stage]
+            ]
+            if busy:
+                logger.warning("🟦Busy, rejecting upload: queue full for %s", busy)
+                if input_type == "audio":
+                    await run_in_threadpool(remove_file_quietly, file_path)
+                return JSONResponse(
+                    status_code=503,
+                    headers={"Retry-After": str(BUSY_RETRY_AFTER_SECS)},
+                    content={
+                        "success": False,
+                        "busy": busy,
+                        "error": "The service is busy right now, please try again in a few minutes",
+                    },
+                )
+
 
 
 
@@ -513,6 +1022,7 @@ async def analyze(
             input_type=input_type,
             current_stage=current_stage,
             file_path=file_path,
+            content_hash=content_hash,
             want_identify=want_identify, 
             want_demucs=want_demucs, 
             want_whisper=want_whisper, 
@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+import os
+from datetime import datetime, timezone
+from decimal import Decimal
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+import orjson
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # br is only offered when the codec is installed; gzip always is
+    brotli = None
+
+# bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+
+def _default(obj):
+    # the few types asyncpg hands back that orjson doesn't serialize natively
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if hasattr(obj, "items"):  # asyncpg.Record
+        return dict(obj.items())
+    raise TypeError(f"not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    """JSON-encode rows straight from asyncpg, skipping jsonable_encoder's tree walk."""
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def make_etag(*parts: Any) -> str:
+    """Weak ETag from whatever identifies a representation (ids, updated_at, query params)."""
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+
+def _as_utc(ts: datetime) -> datetime:
+    # songs.updated_at is a naive TIMESTAMP written in the server's zone (UTC)
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts.astimezone(timezone.utc)
+
+
+def _not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        # If-None-Match wins over If-Modified-Since when both are sent
+        tags = {t.strip() for t in inm.split(",")}
+        return "*" in tags or etag in tags or etag.removeprefix("W/") in tags
+    ims = request.headers.get("if-modified-since")
+    if ims and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(ims)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        # HTTP dates have whole-second precision
+        return _as_utc(last_modified).replace(microsecond=0) <= since
+    return False
+
+
+def _pick_encoding(request: Request) -> Optional[str]:
+    offered = {}
+    for item in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            offered[name.lower()] = q
+    if brotli is not None and offered.get("br", 0) > 0:
+        return "br"
+    if offered.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def json_response(
+    request: Request,
+    content: Any,
+    *,
+    etag: Optional[str] = None,
+    last_modified: Optional[datetime] = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> Response:
+    """
+    200 JSON response with validators, or a bodiless 304 when the client's copy is current.
+
+    Pass `etag` when it can be derived without serializing (e.g. from updated_at) so
+    a 304 skips encoding entirely; otherwise it is a hash of the encoded body.
+    Compresses with br or gzip, whichever the client prefers and we have.
+    """
+    body = None
+    if etag is None:
+        body = dumps(content)
+        etag = make_etag(hashlib.blake2b(body, digest_size=16).digest())
+
+    out = dict(headers or {})
+    out["ETag"] = etag
+    # clients may keep the body but must revalidate before each use
+    out["Cache-Control"] = "no-cache"
+    out["Vary"] = "Accept-Encoding"
+    if last_modified is not None:
+        out["Last-Modified"] = format_datetime(_as_utc(last_modified), usegmt=True)
+
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=out)
+
+    if body is None:
+        body = dumps(content)
+    if len(body) >= COMPRESS_MIN_BYTES:
+        encoding = _pick_encoding(request)
+        if encoding == "br":
+            body = brotli.compress(body, quality=BROTLI_QUALITY)
+            out["Content-Encoding"] = "br"
+        elif encoding == "gzip":
+            body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+            out["Content-Encoding"] = "gzip"
+    return Response(content=body, status_code=200, media_type="application/json", headers=out)
@@ -3,6 +3,7 @@ import time
 import asyncio
 import httpx
 from pathlib import Path
+from typing import Optional
 import logging
 
 logging.basicConfig(
@@ -23,14 +24,261 @@ WHISPER_URL   = os.getenv("WHISPER_URL",   "http://clanker_whisper:8000")
 CLASSIFY_URL  = os.getenv("CLASSIFY_URL",  "http://clanker_classifier:8000")
 
 # Timeouts (connect, read)
-T_IDENTIFY   = (5.0, 120.0)
+# decode + fingerprint + AcoustID in one call. Must outlast acousti's FFMPEG_TIMEOUT_SECS
+# (300) plus a rate-limited lookup (~65s worst case), or we'd retry while it still runs
+T_IDENTIFY   = (5.0, 420.0)
 T_CONVERT    = (5.0, 120.0)
 T_DEMUCS     = (5.0, 900.0)
 T_WHISPER    = (5.0, 600.0)
 T_CLASSIFIER = (5.0, 60.0)
 
-# ------- global async client -------
-_client = httpx.AsyncClient(timeout=None)  # we set per-request timeouts below
+# ------- per-service clients -------
+# Each downstream gets its own keep-alive pool, sized to what it can usefully take at
+# once, so a backed-up Demucs can't hold connections the classifier needs.
+# (max connections, max idle keep-alive connections)
+POOL_LIMITS = {
+    "acousti":  (int(os.getenv("ACOUSTI_MAX_CONNECTIONS",  "8")), 4),
+    "demucs":   (int(os.getenv("DEMUCS_MAX_CONNECTIONS",   "4")), 2),
+    "whisper":  (int(os.getenv("WHISPER_MAX_CONNECTIONS",  "4")), 2),
+    "classify": (int(os.getenv("CLASSIFY_MAX_CONNECTIONS", "8")), 4),
+}
+KEEPALIVE_EXPIRY_SECS = float(os.getenv("KEEPALIVE_EXPIRY_SECS", "60"))
+
+# AIMD in-flight limit per service: +1 per limit's worth of healthy responses,
+# x AIMD_BACKOFF on an error/timeout or a response slower than AIMD_SLOW_FACTOR x its
+# usual latency. Calls over the limit wait here instead of queueing in the container.
+AIMD_BACKOFF = float(os.getenv("AIMD_BACKOFF", "0.7"))
+AIMD_SLOW_FACTOR = float(os.getenv("AIMD_SLOW_FACTOR", "2.0"))
+
+
+class AdaptiveLimit:
+    """Additive-increase / multiplicative-decrease cap on concurrent calls to one service."""
+
+    def __init__(self, name: str, initial: int, max_limit: int, min_limit: int = 1):
+        self.name = name
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.inflight = 0
+        self.waiting = 0
+        self.latency_ewma: Optional[float] = None
+        self.errors = 0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self._cond:
+            self.waiting += 1
+            try:
+                await self._cond.wait_for(lambda: self.inflight < int(self.limit))
+            finally:
+                self.waiting -= 1
+            self.inflight += 1
+
+    async def release(self, latency: Optional[float] = None, error: bool = False) -> None:
+        async with self._cond:
+            self.inflight -= 1
+            if error:
+                self.errors += 1
+                self._decrease()
+            elif latency is not None:
+                slow = self.latency_ewma is not None and latency > self.latency_ewma * AIMD_SLOW_FACTOR
+                self.latency_ewma = latency if self.latency_ewma is None else (
+                    0.9 * self.latency_ewma + 0.1 * latency
+                )
+                if slow:
+                    self._decrease()
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def _decrease(self) -> None:
+        # calls already in flight report the same overload; back off once for all of them
+        now = time.monotonic()
+        if now - self._last_decrease < (self.latency_ewma or 1.0):
+            return
+        self._last_decrease = now
+        old = int(self.limit)
+        self.limit = max(self.min_limit, self.limit * AIMD_BACKOFF)
+        if int(self.limit) < old:
+            logger.warning("%s: concurrency limit %s -> %s", self.name, old, int(self.limit))
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "inflight": self.inflight,
+            "waiting": self.waiting,
+            "latency_ewma_secs": round(self.latency_ewma, 3) if self.latency_ewma else None,
+            "errors": self.errors,
+        }
+
+
+# Circuit breaker per service: BREAKER_FAILURES consecutive failures open it for
+# BREAKER_OPEN_SECS (doubling while probes keep failing, up to BREAKER_MAX_OPEN_SECS);
+# then one probe call is let through and its result closes or reopens it
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_OPEN_SECS = float(os.getenv("BREAKER_OPEN_SECS", "30"))
+BREAKER_MAX_OPEN_SECS = float(os.getenv("BREAKER_MAX_OPEN_SECS", "300"))
+
+
+class ServiceUnavailable(RuntimeError):
+    """Raised instead of calling a service whose breaker is open."""
+
+    def __init__(self, service: str, retry_after: float):
+        super().__init__(f"{service} unavailable (circuit open, retry in {retry_after:.0f}s)")
+        self.service = service
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.open_secs = BREAKER_OPEN_SECS
+        self.open_until = 0.0
+        self.tripped = False
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if not self.tripped:
+            return "closed"
+        return "half_open" if time.monotonic() >= self.open_until else "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        """Seconds until a call could be let through again."""
+        if self.state == "closed":
+            return 0.0
+        # half-open with the probe still out: check back shortly
+        return max(1.0, self.open_until - time.monotonic())
+
+    def claimable(self, free: int) -> int:
+        """How many jobs a worker for this service should claim right now."""
+        state = self.state
+        if state == "closed":
+            return free
+        if state == "half_open" and not self.probing:
+            return min(free, 1)
+        return 0
+
+    def record_success(self) -> None:
+        if self.tripped:
+            logger.info("%s: circuit closed", self.name)
+        self.failures = 0
+        self.tripped = False
+        self.probing = False
+        self.open_secs = BREAKER_OPEN_SECS
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.probing or (not self.tripped and self.failures >= BREAKER_FAILURES):
+            if self.probing:
+                self.open_secs = min(BREAKER_MAX_OPEN_SECS, self.open_secs * 2)
+            self.tripped = True
+            self.probing = False
+            self.open_until = time.monotonic() + self.open_secs
+            logger.warning("%s: circuit open for %.0fs", self.name, self.open_secs)
+
+    def release_probe(self) -> None:
+        # the probe call was cancelled without an answer; let another one through
+        self.probing = False
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "retry_after_secs": round(self.retry_after(), 1)}
+
+
+class Service:
+    """One downstream container: its own connection pool, adaptive limit and breaker."""
+
+    def __init__(self, name: str, base_url: str):
+        max_conns, keepalive = POOL_LIMITS[name]
+        self.name = name
+        # timeout=None here; every call passes its own (connect, read) timeout
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=None,
+            limits=httpx.Limits(
+                max_connections=max_conns,
+                max_keepalive_connections=keepalive,
+                keepalive_expiry=KEEPALIVE_EXPIRY_SECS,
+            ),
+        )
+        self.limit = AdaptiveLimit(name, initial=max(1, max_conns // 2), max_limit=max_conns)
+        self.breaker = CircuitBreaker(name)
+
+    async def post(self, path: str, *, timeout, **kwargs) -> httpx.Response:
+        # fail fast instead of waiting out the full timeout against a dead service
+        if not self.breaker.allow():
+            raise ServiceUnavailable(self.name, self.breaker.retry_after())
+        try:
+            await self.limit.acquire()
+        except BaseException:
+            self.breaker.release_probe()
+            raise
+        start = time.monotonic()
+        try:
+            r = await self.client.post(path, timeout=timeout, **kwargs)
+        except httpx.TransportError:  # connect errors and timeouts
+            self.breaker.record_failure()
+            await self.limit.release(error=True)
+            raise
+        except BaseException:
+            self.breaker.release_probe()
+            await self.limit.release()
+            raise
+        failed = r.status_code >= 500 or r.status_code == 429
+        if failed:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        await self.limit.release(latency=time.monotonic() - start, error=failed)
+        return r
+
+
+SERVICES = {
+    "acousti":  Service("acousti",  ACOUSTI_URL),
+    "demucs":   Service("demucs",   DEMUCS_URL),
+    "whisper":  Service("whisper",  WHISPER_URL),
+    "classify": Service("classify", CLASSIFY_URL),
+}
+
+
+# which service each pipeline stage calls
+STAGE_SERVICES = {
+    "identify": "acousti",
+    "demucs":   "demucs",
+    "whisper":  "whisper",
+    "classify": "classify",
+}
+
+
+def stage_claimable(stage: str, free: int) -> int:
+    """Slots a stage's worker may fill now: 0 while its service's breaker is open."""
+    return SERVICES[STAGE_SERVICES[stage]].breaker.claimable(free)
+
+
+def stage_retry_after(stage: str) -> float:
+    return SERVICES[STAGE_SERVICES[stage]].breaker.retry_after()
+
+
+def service_metrics() -> dict:
+    return {
+        name: {**svc.limit.stats(), "breaker": svc.breaker.stats()}
+        for name, svc in SERVICES.items()
+    }
+
+
+async def close_service_clients() -> None:
+    await asyncio.gather(*(svc.client.aclose() for svc in SERVICES.values()))
 
 
 async def _raise(resp: httpx.Response, ctx: str):
@@ -42,11 +290,14 @@ async def _raise(resp: httpx.Response, ctx: str):
 
 
 # ------- async helpers -------
-async def run_demucs(file_path: str):
+async def run_demucs(file_path: str, output_format: Optional[str] = None):
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Audio not found for Demucs: {file_path}")
 
-    r = await _client.post(f"{DEMUCS_URL}/separate", data={"file_path": file_path}, timeout=T_DEMUCS)
+    data = {"file_path": file_path}
+    if output_format:
+        data["output_format"] = output_format  # the stem's format; see formats.py
+    r = await SERVICES["demucs"].post("/separate", data=data, timeout=T_DEMUCS)
     if r.status_code != 200:
         await _raise(r, "Demucs")
     return r.json()
@@ -56,33 +307,39 @@ async def run_whisper(file_path: str):
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Audio not found for Whisper: {file_path}")
     
-    r = await _client.post(f"{WHISPER_URL}/transcribe", data={"file_path": file_path}, timeout=T_WHISPER)
+    r = await SERVICES["whisper"].post("/transcribe", data={"file_path": file_path}, timeout=T_WHISPER)
     if r.status_code != 200:
         await _raise(r, "Whisper")
     return r.json()
 
 
 async def run_classify(lyrics: str):
-    r = await _client.post(f"{CLASSIFY_URL}/classify", data={"lyrics": lyrics}, timeout=T_CLASSIFIER)
+    r = await SERVICES["classify"].post("/classify", data={"lyrics": lyrics}, timeout=T_CLASSIFIER)
     if r.status_code != 200:
         await _raise(r, "Classifier")
     return r.json()
 
 
-async def run_acousti(file_path: str):
-    try:
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"Audio not found for Acousti: {file_path}")
-        r = await _client.post(f"{ACOUSTI_URL}/convert", data={"file_path": file_path},  timeout=T_IDENTIFY)
-        
-        file_path = r.json()["file_path"]
-        
-        r = await _client.post(f"{ACOUSTI_URL}/identify", data={"file_path": file_path}, timeout=T_IDENTIFY)
-        data = r.json()          # this is the response dict
-        data["file_path"] = file_path   # inject your own field
-        return data
-    except Exception as e:
-        print(e)
+async def run_acousti(file_path: str, output_format: str = ""):
+    """
+    Decode, fingerprint and look up in one pass. output_format is the next audio
+    stage's input format (formats.py); empty when no later stage reads the audio,
+    so nothing is written and file_path comes back None.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"Audio not found for Acousti: {file_path}")
+    r = await SERVICES["acousti"].post(
+        "/analyze",
+        data={"file_path": file_path, "output_format": output_format},
+        timeout=T_IDENTIFY,
+    )
+    if r.status_code == 422:
+        # undecodable / nothing to fingerprint: run_job marks the job failed rather than retrying
+        logger.error("Acousti analyze failed: HTTP %s - %s", r.status_code, r.text[:500])
+        return {"error": r.text[:500], "file_path": None}
+    if r.status_code != 200:
+        await _raise(r, "Acousti analyze")
+    return r.json()
 
 async def preprocess(file_name: str) -> str:
     
@@ -99,7 +356,7 @@ async def preprocess(file_name: str) -> str:
     with open(input_path, "rb") as f:
         files = {'file': (file_name, f)}
         try:
-            r = await _client.post(f"{ACOUSTI_URL}/convert", files=files, timeout=T_CONVERT)
+            r = await SERVICES["acousti"].post("/convert", files=files, timeout=T_CONVERT)
         except httpx.RequestError as e:
             raise RuntimeError(f"Connect to /convert failed: {e}")
 
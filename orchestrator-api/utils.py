@@ -1,9 +1,11 @@
 import os
 import uuid
+import base64
 import hashlib
-import shutil
+from datetime import datetime
 from fastapi import UploadFile
-from typing import Optional, Dict, Any
+from fastapi.concurrency import run_in_threadpool
+from typing import Optional, Dict, Any, Tuple
 
 
 # Shared paths
@@ -21,23 +23,85 @@ os.makedirs(RAW_PATH, exist_ok=True)
 #other os
 FRONTEND_ORIGIN = os.getenv("FRONTEND_ORIGIN", "http://localhost:3000")
 
+# uploads
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+
 
 def compute_fingerprint_hash(fingerprint: str) -> str:
     return hashlib.md5(fingerprint.encode("utf-8")).hexdigest()
 
 
-def save_uploaded_file(upload_file: UploadFile) -> str:
+class UploadTooLarge(Exception):
+    pass
+
+
+async def save_uploaded_file(
+    upload_file: UploadFile,
+    max_bytes: int = MAX_UPLOAD_BYTES,
+) -> Tuple[str, str]:
+    """
+    Stream an upload into RAW_PATH in UPLOAD_CHUNK_BYTES chunks, hashing as we write.
+    Disk writes and hashing run in the threadpool so the event loop (and the
+    in-process workers) never block on a big file.
+    Returns (filename, sha256 hex). Raises UploadTooLarge past `max_bytes`.
+    """
+    if upload_file.size is not None and upload_file.size > max_bytes:
+        raise UploadTooLarge(f"Upload is {upload_file.size} bytes, limit is {max_bytes}")
+
     ext = os.path.splitext(upload_file.filename)[1]
     filename = f"{uuid.uuid4().hex}{ext}"
     file_path = os.path.join(RAW_PATH, filename)
 
-    with open(file_path, "wb") as f:
-        shutil.copyfileobj(upload_file.file, f)
+    hasher = hashlib.sha256()
+    written = 0
+
+    def _write(f, chunk: bytes):
+        f.write(chunk)
+        hasher.update(chunk)
+
+    f = await run_in_threadpool(open, file_path, "wb")
+    try:
+        while True:
+            chunk = await upload_file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > max_bytes:
+                raise UploadTooLarge(f"Upload exceeds limit of {max_bytes} bytes")
+            await run_in_threadpool(_write, f, chunk)
+    except BaseException:
+        await run_in_threadpool(f.close)
+        await run_in_threadpool(remove_file_quietly, file_path)
+        raise
+    await run_in_threadpool(f.close)
 
-    return filename
+    return filename, hasher.hexdigest()
+
+
+def remove_file_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 def make_unique_key(stage: str, file_name: Optional[str], payload: Dict[str,Any]) -> str:
     fp_hash = payload.get("fingerprint_hash") or ""
     base = f"{stage}|{file_name or ''}|{fp_hash}"
     return hashlib.sha1(base.encode()).hexdigest()
 
+
+def encode_song_cursor(created_at: datetime, song_id: int) -> str:
+    """Opaque keyset cursor for /api/songs: the (created_at, id) of the last row sent."""
+    raw = f"{created_at.isoformat()}|{song_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_song_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of encode_song_cursor. Raises ValueError on anything malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, song_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), int(song_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
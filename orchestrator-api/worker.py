@@ -0,0 +1,70 @@
+"""
+Headless pipeline worker: the orchestrator's per-stage workers, reaper and archiver,
+without the HTTP API. Run the web process with ORCHESTRATOR_MODE=api and as many of
+these as the downstream services can feed; they share the queue through SKIP LOCKED
+claims, and the reaper/archiver only run on whichever replica holds their advisory lock.
+
+    python worker.py                                   # every stage, *_WORKERS concurrency
+    python worker.py --stages demucs                   # e.g. next to a GPU
+    python worker.py --stages identify,classify --concurrency classify=8
+"""
+import argparse
+import asyncio
+import logging
+import signal
+from types import SimpleNamespace
+
+from db import STAGES, dsn, setup_db_pool
+from orchestrator_runner import STAGE_WORKERS, start_background_tasks, stop_background_tasks
+from services import close_service_clients
+
+logger = logging.getLogger("orchestrator")
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--stages", default=",".join(STAGES), help="comma-separated stages to run")
+    ap.add_argument(
+        "--concurrency",
+        action="append",
+        default=[],
+        metavar="STAGE=N",
+        help="override a stage's concurrent jobs (repeatable)",
+    )
+    args = ap.parse_args()
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        ap.error(f"unknown stages: {', '.join(unknown)}")
+    for item in args.concurrency:
+        stage, _, n = item.partition("=")
+        if stage not in STAGES or not n.isdigit():
+            ap.error(f"bad --concurrency {item!r}, expected STAGE=N")
+        STAGE_WORKERS[stage] = int(n)
+    return stages
+
+
+async def main(stages):
+    state = SimpleNamespace(db_pool=await setup_db_pool(dsn))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    start_background_tasks(state, workers=True, stages=stages)
+    logger.info(
+        "worker started: %s",
+        ", ".join(f"{s}={STAGE_WORKERS[s]}" for s in stages),
+    )
+    try:
+        await stop.wait()
+    finally:
+        logger.info("worker stopping")
+        await stop_background_tasks(state)
+        await close_service_clients()
+        await state.db_pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
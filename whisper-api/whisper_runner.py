@@ -22,6 +22,12 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/format")
+async def input_format():
+    # whisper hears 16 kHz mono; audio already in that shape skips the resample on load
+    return {"codec": "flac", "rate": model.feature_extractor.sampling_rate, "channels": 1}
+
+
 @app.post("/transcribe")
 async def transcribe(file_path: str = Form(...)):
     logger.info("🟦transcribing vocals")